@@ -2,4 +2,6 @@ from .config import *
 from .preprocess import *
 from .finalise import *
 from .run_sensor_stats import *
-# from .classify_data import *
\ No newline at end of file
+from .benchmark_ica import *
+from .results import *
+from .classify_data import classify_data
@@ -0,0 +1,91 @@
+import os
+import os.path as op
+import json
+import hashlib
+import inspect
+import eeg_pipeline.config as config
+
+# Every output of the pipeline is recorded in a small manifest holding a key made from
+# everything that went into it: the contents of the source files, the relevant config
+# and the source code of the functions that made it. If any of these change the key
+# changes and the output is rebuilt, otherwise it is left alone.
+
+# make the key for an output from its inputs
+def fingerprint(sources=(), params=None, code=(), upstream=None):
+    key = {
+        'sources': [[op.basename(f), file_digest(f)] for f in sources],
+        'params': params,
+        'code': [code_version(func) for func in code],
+        'upstream': upstream,
+    }
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+# the version of a function is the hash of its source code
+def code_version(func):
+    return hashlib.sha1(inspect.getsource(func).encode()).hexdigest()
+
+# sha1 of a file's contents; files that haven't changed since they were last hashed are not read again
+_digests = {}
+def file_digest(fname):
+    if not op.isfile(fname):
+        return None
+    st = os.stat(fname)
+    stamp = [st.st_size, st.st_mtime_ns]
+    if fname in _digests and _digests[fname][0] == stamp:
+        return _digests[fname][1]
+
+    # check the digests saved by previous runs (kept with the pipeline's own files, one file per source
+    # folder, as the raw data may well be read-only)
+    folder = op.abspath(op.dirname(fname))
+    cache_fname = op.join(config.digest_path, 'digests_' + hashlib.sha1(folder.encode()).hexdigest()[:12] + '.json')
+    cache = read_json(cache_fname) or {}
+    name = op.basename(fname)
+    if name in cache and cache[name][0] == stamp:
+        digest = cache[name][1]
+    else:
+        sha = hashlib.sha1()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(2**24), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+        cache = read_json(cache_fname) or {}
+        cache[name] = [stamp, digest]
+        try:
+            write_json(cache_fname, cache)
+        except OSError:
+            # we just can't save it for next time
+            pass
+    _digests[fname] = [stamp, digest]
+    return digest
+
+# manifests live in a hidden folder next to the outputs they describe
+def manifest_fname(path, name):
+    return op.join(path, '.artifacts', name + '.json')
+
+def read_manifest(manifest):
+    return read_json(manifest)
+
+# an output needs rebuilding if it was never made, was made from different inputs, or has gone missing
+def is_stale(manifest, key):
+    rec = read_manifest(manifest)
+    if rec is None or rec['key'] != key:
+        return True
+    return not all(op.isfile(f) for f in rec['outputs'])
+
+# remember that the outputs were made from inputs with this key (plus anything else worth keeping)
+def record(manifest, key, outputs=(), meta=None):
+    write_json(manifest, {'key': key, 'outputs': list(outputs), 'meta': meta})
+
+def read_json(fname):
+    if not op.isfile(fname):
+        return None
+    with open(fname) as f:
+        return json.load(f)
+
+# write via a temporary file so a crash (or another process) never leaves half a file behind
+def write_json(fname, obj):
+    os.makedirs(op.dirname(fname), exist_ok=True)
+    tmp_fname = '%s.%d.tmp' % (fname, os.getpid())
+    with open(tmp_fname, 'w') as f:
+        json.dump(obj, f, indent=4, default=str)
+    os.replace(tmp_fname, fname)
@@ -0,0 +1,48 @@
+import numpy as np
+from scipy import stats
+import mne
+
+# the 10% trimmed mean over the epochs (first) axis, as finalise has always used
+def trim_mean(data):
+    return stats.trim_mean(data, 0.1, axis=0)
+
+# the function to combine the epochs with for the avg_method of a finalise_params set
+def get_avg_method(avg_method):
+    if avg_method == 'trim':
+        # 10% trimmed mean
+        return trim_mean
+    # assumes method will be set as either mean or median otherwise
+    return avg_method
+
+# the methods that can be worked out a block of epochs at a time (the trimmed mean only approximately)
+streamable = ('mean', 'trim')
+
+# the matrix that interpolates the bad channels of info from the good ones (chans * chans); as the
+# interpolation is linear, interpolating an identity matrix gives the matrix that does it
+def interpolation_matrix(info):
+    identity = mne.EvokedArray(np.eye(info['nchan']), info.copy(), tmin=0, verbose=False)
+    identity.interpolate_bads(reset_bads=True)
+    return identity.data
+
+# average epochs (not preloaded) reading block_size of them from disk at a time, interpolating their bad
+# channels with interp, so only one block is in memory. For 'trim' each block's trimmed mean is
+# weighted by its number of epochs, which approximates the trimmed mean of them all.
+def stream_average(epochs, interp, avg_method='mean', block_size=100, comment=None):
+    if avg_method not in streamable:
+        raise ValueError('Can only stream the mean or trimmed mean, not %s' % avg_method)
+    combine = trim_mean if avg_method == 'trim' else (lambda x: x.mean(axis=0))
+
+    # split the epochs into equal blocks so no block is too small to trim
+    n_blocks = max(1, int(np.ceil(len(epochs) / block_size)))
+    total, nave = 0., 0
+    for block in np.array_split(np.arange(len(epochs)), n_blocks):
+        data = np.matmul(interp, epochs[block].get_data())
+        total = total + combine(data) * len(data)
+        nave += len(data)
+
+    info = epochs.info.copy()
+    info['bads'] = []
+    evoked = mne.EvokedArray(total / nave, info, tmin=epochs.times[0], comment=comment, nave=nave)
+    evoked.times = epochs.times.copy()
+    # keep only the data channels, as Epochs.average does
+    return evoked.pick_types(meg=True, eeg=True, seeg=True, ecog=True, exclude=[])
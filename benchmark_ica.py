@@ -0,0 +1,67 @@
+import os.path as op
+import time
+import itertools
+import numpy as np
+import mne
+import pandas as pd
+from scipy.optimize import linear_sum_assignment
+import eeg_pipeline.config as config
+from eeg_pipeline.preprocess import preprocess, read_checkpoints, checkpoint_fnames, drop_bad_data, fit_ica
+
+# the ICA settings to compare by default (anything not given comes from preproc_params)
+default_settings = {
+    'fastica': {'method': 'fastica', 'fit_params': None},
+    'picard': {'method': 'picard', 'fit_params': {'ortho': False, 'extended': True}},
+    'ext-infomax': {'method': 'infomax', 'fit_params': {'extended': True}},
+    'fastica-pca99': {'method': 'fastica', 'fit_params': None, 'n_components': .99},
+    'picard-pca99': {'method': 'picard', 'fit_params': {'ortho': False, 'extended': True}, 'n_components': .99},
+}
+
+# fit the ICA a few times with each setting on one subject's data, and report how long it took and
+# how similar the components are from one random seed to the next (1 = identical)
+def benchmark_ica(subjname, settings=None, n_seeds=3):
+    if settings is None:
+        settings = default_settings
+
+    # use the same (cleaned) epochs that preprocess fits the ICA on
+    preprocess(subjname, stop_after='bad_data')
+    done = read_checkpoints(subjname)
+    _, ica_epo_fname = checkpoint_fnames(subjname)
+    epochs_4_ica = mne.read_epochs(ica_epo_fname)
+    drop_bad_data(epochs_4_ica, done)
+
+    rows = []
+    for name, setting in settings.items():
+        times, maps = [], []
+        try:
+            for seed in range(n_seeds):
+                t0 = time.perf_counter()
+                ica = fit_ica(epochs_4_ica, settings=setting, random_state=seed)
+                times.append(time.perf_counter() - t0)
+                maps.append(ica.get_components())
+        except ImportError as e:
+            print('Skipping {}: {}'.format(name, e))   # e.g. python-picard isn't installed
+            continue
+        rows.append({
+            'setting': name,
+            'n_components': maps[0].shape[1],
+            'time_mean': np.mean(times),
+            'time_min': np.min(times),
+            'stability': np.mean([match_components(a, b) for a, b in itertools.combinations(maps, 2)])
+                         if n_seeds > 1 else np.nan,
+        })
+        print('{}: {:.1f} s, stability {:.3f}'.format(name, rows[-1]['time_mean'], rows[-1]['stability']))
+
+    results = pd.DataFrame(rows).set_index('setting').sort_values('time_mean')
+    print(results)
+    results.to_csv(op.join(config.ica_path, subjname + '_ica_benchmark.csv'))
+    return results
+
+# pair up the components of two ICAs (chans * comps) and return the mean absolute correlation of the pairs
+def match_components(a, b):
+    a = (a - a.mean(axis=0)) / np.linalg.norm(a - a.mean(axis=0), axis=0)
+    b = (b - b.mean(axis=0)) / np.linalg.norm(b - b.mean(axis=0), axis=0)
+    r = np.abs(a.T @ b)
+    rows, cols = linear_sum_assignment(-r)
+    # any components without a partner (if the two have different numbers) count as 0
+    return r[rows, cols].sum() / max(r.shape)
@@ -0,0 +1,146 @@
+import numpy as np
+from scipy import sparse, stats
+from scipy.sparse.csgraph import connected_components
+from scipy.ndimage import gaussian_filter
+from eeg_pipeline.permutation import (ttest_1samp_signs, ttest_ind_labels, neighbour_pairs, tfce, sign_flips,
+                                      t_permutations, check_rng, cluster_test, tfce_test)
+
+# Check the permutation engine against the slow, obvious way of doing the same thing: t values from
+# scipy.stats, and clusters found afresh with connected_components for every map (and every TFCE
+# threshold). Run it (python -m eeg_pipeline.check_permutation) after changing permutation.py; it
+# raises an AssertionError if anything differs.
+
+# smooth random observations * times * chans data, with an effect added in the middle
+def fake_data(rng, n_obs, n_times, n_chans, effect=.8):
+    data = np.array([gaussian_filter(rng.randn(n_times, n_chans), 2) for _ in range(n_obs)]) * 3
+    data[:, n_times // 3:n_times // 2, :n_chans // 4] += effect
+    return data
+
+# a random symmetric channel adjacency
+def fake_adjacency(n_chans, seed=1):
+    adjacency = sparse.random(n_chans, n_chans, density=.1, random_state=seed)
+    return ((adjacency + adjacency.T) > 0).astype(int)
+
+# the graph of neighbouring points of times * chans data
+def point_graph(n_times, n_chans, adjacency):
+    pairs = neighbour_pairs(n_times, n_chans, adjacency)
+    n_points = n_times * n_chans
+    return sparse.coo_matrix((np.ones(len(pairs[0])), pairs), shape=(n_points, n_points)).tocsr()
+
+# the clusters (connected parts of the graph) of the points where keep is true, as a label for each
+# of those points
+def label_points(graph, keep):
+    points = np.flatnonzero(keep)
+    _, labels = connected_components(graph[points][:, points], directed=False)
+    return points, labels
+
+# TFCE scores of the positive values of x, finding the clusters again at every threshold
+def naive_tfce(x, graph, start, step, e_power=.5, h_power=2):
+    scores = np.zeros(x.size)
+    h, k = start, 0
+    while h < x.max():
+        points, labels = label_points(graph, x > h)
+        extent = np.bincount(labels)[labels]
+        scores[points] += extent ** e_power * h ** h_power * step
+        k += 1
+        h = start + k * step
+    return scores
+
+# the largest cluster mass of a t map (the smallest for tail -1), as the permutation tests score them
+def naive_max_mass(t, graph, threshold, tail):
+    best = 0
+    for sign in {1: [1], -1: [-1], 0: [1, -1]}[tail]:
+        points, labels = label_points(graph, sign * t > abs(threshold))
+        if len(points) == 0:
+            continue
+        mass = np.bincount(labels, weights=t[points])
+        best = min(best, mass.min()) if tail == -1 else max(best, np.abs(mass).max())
+    return best
+
+def check_t_maps(rng):
+    a, b = rng.randn(12, 30, 8), rng.randn(9, 30, 8) + .3
+    signs = rng.choice([-1., 1.], size=(20, len(a)))
+    t = ttest_1samp_signs(a, signs)
+    for sign, t_perm in zip(signs, t):
+        assert np.allclose(t_perm, stats.ttest_1samp(a * sign[:, np.newaxis, np.newaxis], 0).statistic)
+
+    pooled = np.concatenate([a, b])
+    labels = np.array([rng.permutation(len(pooled)) < len(a) for _ in range(20)], dtype=float)
+    for equal_var in (True, False):
+        t = ttest_ind_labels(pooled, labels, equal_var)
+        for label, t_perm in zip(labels, t):
+            scipy_t = stats.ttest_ind(pooled[label == 1], pooled[label == 0], equal_var=equal_var).statistic
+            assert np.allclose(t_perm, scipy_t)
+    print('t maps: ok')
+
+# with few observations every sign flip is used once (only one of each mirror image pair for a
+# two-tailed test), the first being the data as they are
+def check_sign_flips(rng):
+    for n_obs in (4, 7):
+        for tail, n_flips in [(0, 2 ** (n_obs - 1)), (1, 2 ** n_obs), (-1, 2 ** n_obs)]:
+            signs = sign_flips(n_obs, 1000, rng, tail)
+            assert len(signs) == n_flips and np.all(signs[0] == 1)
+            if tail == 0:
+                signs = signs * signs[:, -1:]   # one of each mirror image pair
+            assert len({tuple(s) for s in signs}) == n_flips
+    print('sign flips: ok')
+
+def check_tfce(rng, n_times=60, n_chans=32):
+    adjacency = fake_adjacency(n_chans)
+    pairs = neighbour_pairs(n_times, n_chans, adjacency)
+    graph = point_graph(n_times, n_chans, adjacency)
+    for _ in range(3):
+        x = gaussian_filter(rng.randn(n_times, n_chans), 2) * 8
+        for start, step in [(0, .2), (.5, .1)]:
+            pos, neg = naive_tfce(x.ravel(), graph, start, step), naive_tfce(-x.ravel(), graph, start, step)
+            for tail, naive in [(0, pos - neg), (1, pos), (-1, -neg)]:
+                assert np.allclose(tfce(x, pairs, start, step, tail=tail).ravel(), naive)
+    print('tfce: ok')
+
+# the largest statistic of each permutation (H0) found by the tests, against the same permutations'
+# t maps from scipy and their clusters or TFCE scores found one map at a time
+def check_tests(rng, n_times=40, n_chans=24, n_permutations=200):
+    adjacency = fake_adjacency(n_chans)
+    pairs = neighbour_pairs(n_times, n_chans, adjacency)
+    graph = point_graph(n_times, n_chans, adjacency)
+    one_sample = [fake_data(rng, 14, n_times, n_chans)]
+    indep = [fake_data(rng, 10, n_times, n_chans), fake_data(rng, 12, n_times, n_chans, effect=0)]
+
+    for X in (one_sample, indep):
+        threshold = stats.t.ppf(.975, len(X[0]) - 1)
+        for tail in (0, 1, -1):
+            perms = t_permutations(X, n_permutations, check_rng(3), tail=tail)[0]
+            if len(X) == 1:
+                t_maps = [stats.ttest_1samp(X[0] * sign[:, np.newaxis, np.newaxis], 0).statistic for sign in perms]
+            else:
+                pooled = np.concatenate(X)
+                t_maps = [stats.ttest_ind(pooled[order[:len(X[0])]], pooled[order[len(X[0]):]]).statistic
+                          for order in perms]
+            t_maps = [t.ravel() for t in t_maps]
+
+            T_obs, clusters, p_values, H0 = cluster_test(X, adjacency, threshold if tail >= 0 else -threshold,
+                                                         n_permutations, tail, seed=3)
+            assert np.allclose(T_obs.ravel(), t_maps[0])
+            assert np.allclose(H0, [naive_max_mass(t, graph, threshold, tail) for t in t_maps])
+            # the observed clusters are those beyond the threshold in the data as they are
+            for sign in {1: [1], -1: [-1], 0: [1, -1]}[tail]:
+                points, labels = label_points(graph, sign * t_maps[0] > threshold)
+                if len(points) == 0:
+                    continue
+                found = {tuple(np.ravel_multi_index(cluster, (n_times, n_chans))) for cluster in clusters}
+                assert all(tuple(points[labels == label]) in found for label in np.unique(labels))
+
+            _, _, _, H0 = tfce_test(X, adjacency, {'start': 0, 'step': .2}, n_permutations, tail, seed=3)
+            scores = [tfce(t, pairs, 0, .2, tail=tail) for t in t_maps]
+            assert np.allclose(H0, [s.min() if tail == -1 else np.abs(s).max() for s in scores])
+    print('cluster_test and tfce_test: ok')
+
+def check_permutation(seed=0):
+    rng = np.random.RandomState(seed)
+    check_t_maps(rng)
+    check_sign_flips(rng)
+    check_tfce(rng)
+    check_tests(rng)
+
+if __name__ == '__main__':
+    check_permutation()
@@ -6,96 +6,167 @@ from sklearn.preprocessing import StandardScaler
 from sklearn.linear_model import LogisticRegression
 
 import mne
-from mne.datasets import sample
 from mne.decoding import (SlidingEstimator, GeneralizingEstimator, Scaler,
                           cross_val_multiscore, LinearModel, get_coef,
                           Vectorizer, CSP)
 
 import os.path as op
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import eeg_pipeline.config as config
-
-filepath = config.epoch_path
-
-test_auc = True
-nperms = 200
-
-t_by_t = False
-
-if t_by_t:
-    n_pnts = 50
-else:
-    n_pnts = 1
-
-allscores = np.ndarray((n_pnts,24))
-perm_allscores = np.ndarray((n_pnts,24,nperms))
-max_perm_allscores = np.ndarray((24,nperms))
-allscores_pval = np.ndarray((n_pnts,24))
-
-for subj in np.arange(0,24):
-
-    dat_file = ('S%02d_EB-epo' % (subj+1))
-    dat_file = op.join(filepath, dat_file + '.fif')
-    epochs = mne.read_epochs(dat_file)
-    epochs.crop(tmin=0, tmax=1)
-    epochs.resample(50)
-    X0 = epochs['motor'].get_data()
-
-    # dat_file = ('S%02d_EB-epo' % (subj+1))
-    # dat_file = op.join(filepath, dat_file + '.fif')
-    # epochs = mne.read_epochs(dat_file)
-    # epochs.crop(tmin=0, tmax=1)
-    # epochs.resample(50)
-    X1 = epochs['non-motor'].get_data()
-
-    X = np.concatenate((X0,X1),axis=0)
-    y = np.concatenate((np.zeros(X0.shape[0]),np.ones(X1.shape[0])),axis=0)
-
-    if t_by_t:
+from eeg_pipeline.permutation import decided
+from eeg_pipeline.parallel import get_n_workers
+from eeg_pipeline.decoding import stratified_folds, ridge_scores
+
+# Decode the conditions of each subject's epochs, and test the scores against label permutations.
+# Every (subject, permutation) is a unit of work of its own, run in a pool of processes, with its own
+# random labels drawn from (seed, subject, permutation), so the results don't depend on the number of
+# workers or the order the units finish in. Permutation 0 is the real labels. With the 'ridge' method
+# a unit is a whole batch of a subject's permutations, as they are all classified at once.
+def classify_data(params=None, n_workers=None, plot=True):
+    params = dict(config.decoding_params, **(params or {}))
+    subjlist = params['subjlist']
+    nperms = params['n_perms'] if params['test_auc'] else 0
+    stop_confidence = params.get('stop_confidence')
+    n_workers = get_n_workers(n_workers)
+
+    scores = {} # (subject, permutation) -> mean score over the folds at each time point
+    # the next permutation of each subject still to run
+    next_perm = {subj: 0 for subj in range(len(subjlist))}
+    with ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else nullcontext() as pool:
+        while next_perm:
+            # run the subjects still going a batch of permutations (or all of them) at a time
+            units = []
+            for subj, start in next_perm.items():
+                stop = nperms + 1 if stop_confidence is None else min(start + params['check_every'], nperms + 1)
+                if params['method'] == 'ridge':
+                    units.append((subj, tuple(range(start, stop))))
+                else:
+                    units += [(subj, (perm,)) for perm in range(start, stop)]
+                next_perm[subj] = stop
+            scores.update(run_units(pool, units, params))
+
+            # stop the subjects that are done, or clear enough whether each time point is significant
+            for subj in list(next_perm):
+                used = next_perm[subj] - 1
+                if used >= nperms:
+                    del next_perm[subj]
+                elif used > 0:
+                    exceed = (perm_maxima(scores, subj, used)[:, np.newaxis] > scores[subj, 0]).sum(axis=0)
+                    if decided(exceed, used, params['alpha'], stop_confidence):
+                        del next_perm[subj]
+
+    # gather the scores into subjects' columns (with nan for permutations that weren't needed)
+    n_pnts = len(scores[0, 0])
+    allscores = np.ndarray((n_pnts,len(subjlist)))
+    perm_allscores = np.full((n_pnts,len(subjlist),nperms), np.nan)
+    max_perm_allscores = np.full((len(subjlist),nperms), np.nan)
+    allscores_pval = np.ndarray((n_pnts,len(subjlist)))
+    nperms_used = np.zeros(len(subjlist), dtype=int)
+    for subj in np.arange(len(subjlist)):
+        allscores[:,subj] = scores[subj, 0]
+        nperms_used[subj] = len([1 for s, perm in scores if s == subj and perm > 0])
+        for perm in np.arange(nperms_used[subj]):
+            perm_allscores[:,subj,perm] = scores[subj, perm + 1]
+        max_perm_allscores[subj,:nperms_used[subj]] = perm_maxima(scores, subj, nperms_used[subj])
+        allscores_pval[:,subj] = [np.mean(max_perm_allscores[subj,:nperms_used[subj]] > allscores[t,subj])
+                                  for t in np.arange(n_pnts)]
+        print('{}: {} permutations'.format(subjlist[subj], nperms_used[subj]))
+
+    if plot:
+        plot_scores(allscores, allscores_pval, params)
+
+    return {'allscores': allscores, 'perm_allscores': perm_allscores, 'max_perm_allscores': max_perm_allscores,
+            'allscores_pval': allscores_pval, 'nperms_used': nperms_used}
+
+# the best score over time of each of a subject's first n permutations
+def perm_maxima(scores, subj, n):
+    return np.array([np.max(scores[subj, perm]) for perm in range(1, n + 1)])
+
+# run the (subject, permutations) units in the pool (or here, if there isn't one), returning
+# {(subject, permutation): scores}
+def run_units(pool, units, params):
+    scores = {}
+    if pool is None:
+        for subj, perms in units:
+            scores.update(decode_unit(subj, perms, params))
+        return scores
+    futures = [pool.submit(decode_unit, subj, perms, params) for subj, perms in units]
+    for future in as_completed(futures):
+        scores.update(future.result())
+    return scores
+
+# the cross-validated scores of one subject with some permutations of their labels (0 for the real ones)
+def decode_unit(subj, perms, params):
+    X, y, _ = decoding_data(params['subjlist'][subj], params)
+    labels = [perm_labels(y, subj, perm, params) for perm in perms]
+    if params['method'] == 'ridge':
+        # every permutation at once, with the same folds (stratified by the real labels)
+        folds = stratified_folds(y, params['cv'])
+        scores = ridge_scores(X, np.array(labels).T, folds, params['ridge_alpha'], params['t_by_t'])
+        return {(subj, perm): scores[:, i] for i, perm in enumerate(perms)}
+    return {(subj, perm): logistic_scores(X, y_perm, params) for perm, y_perm in zip(perms, labels)}
+
+# the labels of a permutation, drawn from its own seed
+def perm_labels(y, subj, perm, params):
+    if perm == 0:
+        return y
+    return np.random.RandomState([params['seed'], subj, perm]).permutation(y)
+
+# the cross-validated scores of a logistic regression, refitted for every fold
+def logistic_scores(X, y, params):
+    if params['t_by_t']:
         clf = make_pipeline(StandardScaler(), LogisticRegression(solver='lbfgs'))
-        time_decod = SlidingEstimator(clf, n_jobs=1, scoring='roc_auc', verbose=True)    
-        scores = cross_val_multiscore(time_decod, X, y, cv=5, n_jobs=1)
+        time_decod = SlidingEstimator(clf, n_jobs=1, scoring='roc_auc', verbose=True)
+        scores = cross_val_multiscore(time_decod, X, y, cv=params['cv'], n_jobs=1)
     else:
         clf = make_pipeline(Vectorizer(), StandardScaler(), LogisticRegression(solver='lbfgs'))
-        scores = cross_val_multiscore(clf, X, y, cv=5, n_jobs=1) 
+        scores = cross_val_multiscore(clf, X, y, cv=params['cv'], n_jobs=1)
 
     # Mean scores across cross-validation splits
-    allscores[:,subj] = np.mean(scores, axis=0)
-    
-    if test_auc:
-        for perm in np.arange(nperms):
-            perm_y = np.random.permutation(y)
-            if t_by_t:
-                perm_clf = make_pipeline(StandardScaler(), LogisticRegression(solver='lbfgs'))
-                perm_time_decod = SlidingEstimator(perm_clf, n_jobs=1, scoring='roc_auc', verbose=True)    
-                perm_scores = cross_val_multiscore(perm_time_decod, X, perm_y, cv=5, n_jobs=1)
-            else:
-                perm_clf = make_pipeline(Vectorizer(), StandardScaler(), LogisticRegression(solver='lbfgs'))
-                perm_scores = cross_val_multiscore(perm_clf, X, perm_y, cv=5, n_jobs=1)
-            
-            perm_allscores[:,subj,perm] = np.mean(perm_scores, axis=0)
-            max_perm_allscores[subj,perm] = np.max(perm_allscores[:,subj,perm])
-    
-    allscores_pval[:,subj] = [np.mean(max_perm_allscores[subj,:] > allscores[t,subj]) for t in np.arange(n_pnts)]
-
-if t_by_t:
-    # Plot
-    fig, ax = plt.subplots()
-    ax.plot(epochs.times, np.mean(allscores,axis=1), label='score')
-    ax.axhline(.5, color='k', linestyle='--', label='chance')
-    ax.set_xlabel('Times')
-    ax.set_ylabel('AUC')  # Area Under the Curve
-    ax.legend()
-    ax.axvline(.0, color='k', linestyle='-')
-    ax.set_title('Sensor space decoding')
-    plt.show()
-    print('done')
-
-    for subj in np.arange(0,24):
-        plt.subplot(4,6,subj+1)
-        plt.plot(epochs.times, allscores_pval[:,subj], label='score')
-        plt.ylim((0, .2))
-        plt.axhline(.05, color='k', linestyle='--', label='chance')
-        plt.axvline(.0, color='k', linestyle='-')
-    plt.show()
-else:
-    print('There were {} significant classifications'.format(np.sum(allscores_pval<.05)))
\ No newline at end of file
+    return np.atleast_1d(np.mean(scores, axis=0))
+
+# the data (trials * chans * times), labels and times of a subject, only loaded once in each process
+_data = {}
+def decoding_data(subjname, params):
+    key = (subjname, tuple(params['condnames']), tuple(params['twin']), params['resample'])
+    if key not in _data:
+        dat_file = op.join(config.epoch_path, subjname + '-epo.fif')
+        epochs = mne.read_epochs(dat_file)
+        epochs.crop(tmin=params['twin'][0], tmax=params['twin'][1])
+        epochs.resample(params['resample'])
+        X0 = epochs[params['condnames'][0]].get_data()
+        X1 = epochs[params['condnames'][1]].get_data()
+
+        X = np.concatenate((X0,X1),axis=0)
+        y = np.concatenate((np.zeros(X0.shape[0]),np.ones(X1.shape[0])),axis=0)
+        _data[key] = (X, y, epochs.times)
+    return _data[key]
+
+def plot_scores(allscores, allscores_pval, params):
+    if params['t_by_t']:
+        times = decoding_data(params['subjlist'][0], params)[2]
+        # Plot
+        fig, ax = plt.subplots()
+        ax.plot(times, np.mean(allscores,axis=1), label='score')
+        ax.axhline(.5, color='k', linestyle='--', label='chance')
+        ax.set_xlabel('Times')
+        ax.set_ylabel('AUC')  # Area Under the Curve
+        ax.legend()
+        ax.axvline(.0, color='k', linestyle='-')
+        ax.set_title('Sensor space decoding')
+        plt.show()
+        print('done')
+
+        for subj in np.arange(allscores.shape[1]):
+            plt.subplot(4,6,subj+1)
+            plt.plot(times, allscores_pval[:,subj], label='score')
+            plt.ylim((0, .2))
+            plt.axhline(params['alpha'], color='k', linestyle='--', label='chance')
+            plt.axvline(.0, color='k', linestyle='-')
+        plt.show()
+    else:
+        print('There were {} significant classifications'.format(np.sum(allscores_pval<params['alpha'])))
+
+if __name__ == '__main__':
+    classify_data()
@@ -0,0 +1,74 @@
+import numpy as np
+from scipy.signal import welch
+import eeg_pipeline.config as config
+
+# score every ICA component against eye and muscle artifact signatures, and pick the ones to reject
+def classify_ica(ica, epochs_4_ica, thresh=None):
+    if thresh is None:
+        thresh = config.preproc_params.get('ica_auto_thresh', {})
+    thresh = dict({'eog': .5, 'template': .9, 'muscle': -.5}, **thresh)
+
+    # time courses of the components (epochs * comps * times)
+    sources = ica.get_sources(epochs_4_ica).get_data()
+
+    scores = {
+        'template': template_scores(ica),
+        'eog': eog_scores(sources, epochs_4_ica),
+        'muscle': muscle_scores(sources, epochs_4_ica.info['sfreq']),
+    }
+
+    # reject any component that crosses any of the thresholds
+    exclude = []
+    reasons = {}
+    for comp in range(sources.shape[1]):
+        why = [k for k in scores if scores[k] is not None and scores[k][comp] > thresh[k]]
+        if why:
+            exclude.append(comp)
+            reasons[comp] = why
+
+    # keep everything as plain lists so it can go in the subject's json
+    scores = {k: (None if v is None else [float(x) for x in v]) for k, v in scores.items()}
+    return exclude, {'scores': scores, 'thresh': thresh, 'exclude': exclude,
+                     'reasons': {str(k): v for k, v in reasons.items()}}
+
+# absolute correlation of each component's topography with blink and saccade shaped maps
+def template_scores(ica):
+    pos = np.array([ch['loc'][:3] for ch in ica.info['chs'] if ch['ch_name'] in ica.ch_names])
+    if not np.all(np.isfinite(pos)) or np.allclose(pos, 0):
+        return None     # no channel locations
+    pos = pos - pos.mean(axis=0)
+    pos = pos / np.linalg.norm(pos, axis=1, keepdims=True)
+    x, y = pos[:, 0], pos[:, 1]
+    # blinks are strongest over the frontal pole, saccades have opposite polarity either side of it
+    frontal = np.clip(y, 0, None) ** 2
+    templates = [frontal, frontal * x]
+
+    maps = ica.get_components()     # chans * comps
+    return np.max([np.abs(corr(maps.T, t)) for t in templates], axis=0)
+
+# absolute correlation of each component's time course with the bipolar EOG channels (if we kept any)
+def eog_scores(sources, epochs_4_ica):
+    eog_idx = [i for i, ch in enumerate(epochs_4_ica.info['chs']) if ch['ch_name'] in ('HEOG', 'VEOG')]
+    if not eog_idx:
+        return None
+    eog = epochs_4_ica.get_data()[:, eog_idx, :]
+    # concatenate the epochs to get one long time course per component / eog channel
+    comps = np.moveaxis(sources, 1, 0).reshape(sources.shape[1], -1)
+    eog = np.moveaxis(eog, 1, 0).reshape(len(eog_idx), -1)
+    return np.max([np.abs(corr(comps, e)) for e in eog], axis=0)
+
+# slope of each component's log-log spectrum; muscle is broadband, so its spectrum is flat (or rising)
+def muscle_scores(sources, sfreq, fmin=7, fmax=35):
+    freqs, psd = welch(sources, fs=sfreq, nperseg=sources.shape[-1], axis=-1)
+    psd = psd.mean(axis=0)      # average over epochs -> comps * freqs
+    band = (freqs >= fmin) & (freqs <= fmax)
+    log_f = np.log10(freqs[band])
+    log_f = log_f - log_f.mean()
+    log_p = np.log10(psd[:, band])
+    return np.sum(log_f * (log_p - log_p.mean(axis=1, keepdims=True)), axis=1) / np.sum(log_f ** 2)
+
+# correlation of each row of x with the vector t
+def corr(x, t):
+    x = x - x.mean(axis=1, keepdims=True)
+    t = t - t.mean()
+    return x @ t / (np.linalg.norm(x, axis=1) * np.linalg.norm(t))
@@ -11,6 +11,18 @@ raw_path = os.path.join(cwd,'Raw')
 epoch_path = os.path.join(cwd,'Epochs')
 evoked_path = os.path.join(cwd,'Finalised')
 stat_path = os.path.join(cwd,'Stats')
+ica_path = os.path.join(cwd,'ICA')
+log_path = os.path.join(cwd,'Logs')
+digest_path = os.path.join(cwd,'.artifacts')   # where the hashes of input files are remembered
+
+# parallel processing and memory use
+n_workers = None        # None means as many as the cores and memory allow
+mem_per_worker = 4      # roughly how many GB of RAM one subject needs
+n_jobs = 1              # cores used within a single subject (e.g. filtering channels)
+memmap_path = None      # folder for memory-mapped scratch copies of the raw data; None keeps it in RAM
+share_path = None       # folder for data shared with parallel jobs (e.g. permutations); None uses /dev/shm
+share_min_size = '1M'   # only share arrays bigger than this, smaller ones are just copied
+perm_mem = .5           # roughly how many GB of permutations a stats run works on at a time
 
 #### PREPROCESSING ####
 
@@ -25,12 +37,25 @@ preproc_params = {
     'hi_pass': .01,
     'lo_pass': 40,
     'epoch_win': [-.375,1],
-    'base_win': (-.2, 0)
+    'base_win': (-.2, 0),
+    'z_thresh': 3,      # FASTER bad data threshold; a number, or a dict with one per criterion
+    'hurst': True,      # also reject channels on their Hurst exponent
+    'ica_method': 'fastica',    # 'fastica', 'picard' (needs python-picard) or 'infomax'
+    'ica_fit_params': None,     # passed to the ICA method, e.g. dict(extended=True) for extended infomax
+    'ica_n_components': None,   # None for full rank, or reduce with PCA first to an int or a fraction of variance
+    'ica_decim': 3,             # only fit on every nth sample, to make it faster
+    'ica_select': 'manual',     # 'manual' (by eye), 'auto' (unattended) or 'review' (auto, then check by eye)
+    'ica_auto_thresh': {'eog': .5, 'template': .9, 'muscle': -.5}  # auto-reject components scoring above these
 }
 
 
 #### FINALISE ####
 
+# average the epochs reading this many from disk at a time, rather than loading each subject whole,
+# to bound the memory for very long sessions (None to load them whole). Sets with bandpower are
+# always loaded whole, as are sets averaged by median, and a trimmed mean is only approximate when streamed.
+finalise_block = None
+
 finalise_params = (
     # finalise 1
     {
@@ -40,7 +65,7 @@ finalise_params = (
                     ],
         'suffix': 'erp',
         'condnames': ['motor','non-motor'], 
-        'subconds': None,
+        'subconds': [['motor','non-motor']],  # pairs of condnames to subtract (first minus second), or None
         'avg_method': 'trim',
         'lo_pass': 20,
         'base_win': (-.2, 0)
@@ -54,6 +79,8 @@ finalise_params = (
         'suffix': 'alpha',
         'condnames': ['motor','non-motor'],
         'bandpower': [8, 13],
+        'bandpower_method': 'filterbank',  # all bands from one FFT ('filter' for a time-domain filter per band)
+        'bandpower_dtype': 'float32',      # precision of the envelopes (float32 stores the envelope arrays at half size)
         'avg_method': 'trim',
         'lo_pass': 20,
         'base_win': (-.2, 0)
@@ -67,6 +94,8 @@ finalise_params = (
         'suffix': 'beta',
         'condnames': ['motor','non-motor'],
         'bandpower': [13, 30],
+        'bandpower_method': 'filterbank',
+        'bandpower_dtype': 'float32',
         'avg_method': 'trim',
         'lo_pass': 20,
         'base_win': (-.2, 0)
@@ -135,10 +164,17 @@ stats_params = [
     #     'statwin': [.16, .27],
     #     'condnames': ['motor','non-motor'], # Only used for plotting and storing if is a group study
     #     'stat': 'dep',                            # indep or dep
+    #     'equal_var': True,                          # for indep, False for Welch's t-test
+    #     'diff_files': None,  # for dep, the differences saved by finalise (e.g. 'S01_EB-epo_erp_motor_minus_non-motor-ave'), used instead of subtracting dat1 from dat0 (dat0_files and dat1_files can then be left out)
     #     'threshold': .05,  # alpha of the parametric step; for TFCE=dict(start=0, step=0.2)
     #     'p_accept': .05,                            # cluster threshold
     #     'tail': 0,                                  # tail of test; 1, 0, or -1
-    #     'n_permutations': 1000                       # at least 1000
+    #     'n_permutations': 1000,                      # at least 1000
+    #     'stop_confidence': None,                    # e.g. .99 to stop permuting once every p is this surely either side of p_accept
+    #     'n_jobs': 8,                                # cores to run the permutations on (default n_jobs)
+    #     'buffer_size': 1000,                        # permute this many tests at a time (None for all at once)
+    #     'seed': None,                               # random seed; None for one fixed by the analysis_name
+    #     'perm_mem': .5,                             # GB of permutations at a time (default perm_mem)
     #     },
     # {
     #     'analysis_name': 'alpha',   # the analysis will be saved under this name, so make it good        
@@ -327,4 +363,28 @@ stats_params = [
         'tail': -1,                                  # tail of test; 1, 0, or -1
         'n_permutations': 1000                       # at least 1000
         }        
-    ]   
\ No newline at end of file
+    ]   
+
+
+#### DECODING ####
+
+# define decoding parameters here (see classify_data)
+decoding_params = {
+    'subjlist': ['S01_EB', 'S02_EB', 'S03_EB', 'S04_EB', 'S05_EB', 'S06_EB', 'S07_EB', 'S08_EB',
+                'S09_EB', 'S10_EB', 'S11_EB', 'S12_EB', 'S13_EB', 'S14_EB', 'S15_EB', 'S16_EB',
+                'S17_EB', 'S18_EB', 'S19_EB', 'S20_EB', 'S21_EB', 'S22_EB', 'S23_EB', 'S24_EB'
+                ],
+    'condnames': ['motor','non-motor'],     # the two conditions to tell apart
+    'twin': [0, 1],                         # time window of the epochs to decode
+    'resample': 50,                         # sampling rate to decode at
+    't_by_t': False,                        # decode each time point separately, or all at once
+    'method': 'logistic',                   # 'logistic' refits each permutation; 'ridge' classifies them all at once (and scores AUC)
+    'ridge_alpha': 1.,                      # regularisation of the ridge classifier
+    'cv': 5,                                # cross-validation folds
+    'test_auc': True,                       # test the scores against label permutations
+    'n_perms': 200,                         # permutations per subject
+    'seed': 0,                              # random seed of the permutations
+    'stop_confidence': None,                # e.g. .99 to stop a subject's permutations once each p is this surely either side of alpha
+    'alpha': .05,
+    'check_every': 20,                      # permutations between checks for stopping
+}
@@ -0,0 +1,53 @@
+import numpy as np
+from scipy import stats
+
+# Cross-validated ridge classification of many labellings of the same data at once. Only the labels
+# change from one permutation to the next, and the ridge solution is linear in them: in its dual form
+# the test trials' decision values are A @ y, where A (test * train trials) only depends on the data
+# and the fold. So A is worked out once for each fold, and every permutation's decision values come
+# from one matrix product. The scores are the area under the ROC curve, from the ranks of the values.
+
+# fold number of each trial, stratified by the (real) labels y: each class is dealt out in turn
+# across the folds, in trial order
+def stratified_folds(y, n_folds=5):
+    folds = np.zeros(len(y), dtype=int)
+    for label in np.unique(y):
+        trials = np.flatnonzero(y == label)
+        folds[trials] = np.arange(len(trials)) % n_folds
+    return folds
+
+# the matrix giving the decision values of the test trials from the labels of the training trials, for
+# ridge regression on the features (trials * features) scaled by the training trials' mean and sd
+def ridge_operator(train, test, alpha=1.):
+    mean, sd = train.mean(axis=0), train.std(axis=0)
+    sd[sd == 0] = 1
+    train = (train - mean) / sd
+    test = (test - mean) / sd
+    # w = train.T @ inv(train @ train.T + alpha * I) @ y, so the test values are test @ w
+    gram = train @ train.T
+    gram[np.diag_indices_from(gram)] += alpha
+    return np.linalg.solve(gram, train @ test.T).T
+
+# area under the ROC curve of the decision values (trials * labellings) for each labelling (of 0/1)
+def rank_auc(values, labels):
+    ranks = stats.rankdata(values, axis=0)
+    n_pos = labels.sum(axis=0)
+    n_neg = len(labels) - n_pos
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return ((ranks * labels).sum(axis=0) - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+
+# the mean AUC over the folds of each labelling (the columns of Y, trials * labellings, of 0/1) of
+# X (trials * chans * times): one score for all the data at once, or one per time point if t_by_t
+def ridge_scores(X, Y, folds, alpha=1., t_by_t=False):
+    if t_by_t:
+        features = [X[:, :, t] for t in range(X.shape[2])]
+    else:
+        features = [X.reshape(len(X), -1)]
+    scores = np.zeros((len(features), Y.shape[1]))
+    n_folds = folds.max() + 1
+    for fold in range(n_folds):
+        train, test = folds != fold, folds == fold
+        for i, feats in enumerate(features):
+            values = ridge_operator(feats[train], feats[test], alpha) @ Y[train]
+            scores[i] += rank_auc(values, Y[test])
+    return scores / n_folds
@@ -0,0 +1,105 @@
+import functools
+import numpy as np
+import mne
+from mne.parallel import parallel_func
+from scipy.signal import fftconvolve
+from scipy.fftpack import next_fast_len
+import eeg_pipeline.config as config
+
+# design the FIR kernel for a band (either edge can be None) just once per sampling rate and length
+@functools.lru_cache(maxsize=None)
+def design_bandpass(sfreq, l_freq, h_freq, filter_length='auto'):
+    h = mne.filter.create_filter(None, sfreq, l_freq, h_freq, filter_length=filter_length,
+                                 fir_design='firwin', verbose=False)
+    h.setflags(write=False)     # it is shared between calls, so make sure nobody changes it
+    return h
+
+# zero-phase filter a single channel with a (linear phase) FIR kernel in one FFT pass
+def filter_1d(x, h):
+    # mirror the edges to reduce the filter transients, as mne does for raw data
+    n_edge = max(min(len(h), len(x)) - 1, 0)
+    x_ext = np.concatenate([2 * x[0] - x[n_edge:0:-1], x, 2 * x[-1] - x[-2:-n_edge - 2:-1]])
+    # compensate for the delay of the kernel and remove the mirrored edges
+    shift = (len(h) - 1) // 2 + n_edge
+    return fftconvolve(x_ext, h, mode='full')[shift:shift + len(x)]
+
+# band-pass filter all the data channels of a (preloaded) raw in place, in one pass per channel
+def bandpass_raw(raw, l_freq, h_freq, n_jobs=None):
+    if n_jobs is None:
+        n_jobs = config.n_jobs
+    h = design_bandpass(raw.info['sfreq'], l_freq, h_freq)
+    picks = mne.pick_types(raw.info, meg=True, eeg=True, seeg=True, ecog=True, exclude=[])
+    raw.apply_function(filter_1d, picks=picks, n_jobs=n_jobs, channel_wise=True, h=h)
+
+    # keep track of the filtering as mne would
+    if l_freq is not None and l_freq > raw.info['highpass']:
+        raw.info['highpass'] = float(l_freq)
+    if h_freq is not None and h_freq < raw.info['lowpass']:
+        raw.info['lowpass'] = float(h_freq)
+    return raw
+
+# band-pass filter channels of a raw into a new array, keeping only every decim-th sample
+# (only one full-rate channel is held in memory at a time, per job)
+def bandpass_decim(raw, l_freq, h_freq, decim, picks, n_jobs=None):
+    if n_jobs is None:
+        n_jobs = config.n_jobs
+    h = design_bandpass(raw.info['sfreq'], l_freq, h_freq)
+    parallel, p_fun, _ = parallel_func(filter_decim_1d, n_jobs)
+    return np.array(parallel(p_fun(raw.get_data(picks=[p])[0], h, decim) for p in picks))
+
+def filter_decim_1d(x, h, decim):
+    return filter_1d(x, h)[::decim]
+
+# amplitude envelopes of the picked channels of data (epochs * chans * times) in several frequency bands
+# from one FFT of each signal: each band is cut out of the spectrum, keeping only the positive
+# frequencies, which gives the analytic signal of the band-passed data straight away
+def hilbert_envelopes(data, sfreq, bands, dtype=np.float64, block_mb=256, picks=None):
+    if picks is None:
+        picks = np.arange(data.shape[1])
+    n_epochs, n_times = data.shape[0], data.shape[-1]
+    # mirror the edges to reduce the transients, as in filter_1d
+    n_edge = n_times - 1
+    n_fft = next_fast_len(n_times + 2 * n_edge)
+    masks = [band_mask(n_fft, sfreq, l_freq, h_freq) for l_freq, h_freq in bands]
+
+    # work through the epochs in blocks to keep the complex spectra small, and only ever copy
+    # (the picks of) one block of the data
+    envelopes = [np.empty((n_epochs, len(picks), n_times), dtype) for band in bands]
+    n_block = max(1, int(block_mb * 1024**2 // (n_fft * 16 * 2 * len(picks))))
+    for start in range(0, n_epochs, n_block):
+        x = data[start:start + n_block][:, picks].reshape(-1, n_times)
+        x_ext = np.concatenate([2 * x[:, :1] - x[:, n_edge:0:-1], x,
+                                2 * x[:, -1:] - x[:, -2:-n_edge - 2:-1]], axis=1)
+        spectrum = np.fft.fft(x_ext, n_fft, axis=-1)
+        for env, mask in zip(envelopes, masks):
+            analytic = np.fft.ifft(spectrum * mask, axis=-1)[:, n_edge:n_edge + n_times]
+            env[start:start + n_block] = np.abs(analytic).reshape(-1, len(picks), n_times)
+    return envelopes
+
+# the spectral mask (over np.fft.fftfreq) that band-passes and makes the analytic signal in one go;
+# the band edges have raised-cosine transitions as wide as mne's default FIR filters, with half
+# amplitude in the middle of each as for a firwin design
+@functools.lru_cache(maxsize=None)
+def band_mask(n_fft, sfreq, l_freq, h_freq):
+    freqs = np.fft.fftfreq(n_fft, 1. / sfreq)
+    gain = np.ones(n_fft)
+    if l_freq is not None:
+        l_trans = min(max(l_freq * 0.25, 2.), l_freq)
+        gain *= cosine_ramp(freqs, l_freq - l_trans, l_freq)
+    if h_freq is not None:
+        h_trans = min(max(h_freq * 0.25, 2.), sfreq / 2. - h_freq)
+        gain *= 1 - cosine_ramp(freqs, h_freq, h_freq + h_trans)
+    # doubling the positive and dropping the negative frequencies gives the analytic signal
+    mask = np.where(freqs > 0, 2 * gain, 0.)
+    mask[0] = gain[0]
+    if n_fft % 2 == 0:
+        mask[n_fft // 2] = gain[n_fft // 2]     # the nyquist frequency is both positive and negative
+    mask.setflags(write=False)
+    return mask
+
+# 0 below f_start, 1 above f_stop and half a cosine in between
+def cosine_ramp(freqs, f_start, f_stop):
+    if f_stop <= f_start:
+        return (np.abs(freqs) >= f_stop).astype(float)
+    t = np.clip((np.abs(freqs) - f_start) / (f_stop - f_start), 0, 1)
+    return 0.5 - 0.5 * np.cos(np.pi * t)
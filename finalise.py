@@ -4,69 +4,196 @@ import sys
 import numpy as np
 import eeg_pipeline.config as config
 import pandas as pd
+import eeg_pipeline.artifacts as artifacts
+from eeg_pipeline.filtering import hilbert_envelopes
+import eeg_pipeline.filtering as filtering
+import eeg_pipeline.averaging as averaging
+from eeg_pipeline.parallel import map_subjects
 
-def finalise():
-    # loop through all sets of finalising    
-    for c in np.arange(len(config.finalise_params)):    
-        # metadata to store for later reporting
-        metadat = []
-        # get list of subjects to work through
-        subjlist = config.finalise_params[c]['subjlist']
-        # work out which sort of averaging to perform
-        if config.finalise_params[c]['avg_method'] == 'trim':
-            # 10% trimmed mean
-            from scipy.stats import trim_mean
-            avg_method = lambda x: trim_mean(x, 0.1, axis=0)
+def finalise(n_workers=None, dry_run=False):
+    stale = [] # what needs to be (re)computed
+    # metadata to store for later reporting, for each set of finalising
+    metadat = [{} for params in config.finalise_params]
+    # work out which sets each subject needs finalising for (keeping the subjects in order)
+    todo = {}
+    for c, params in enumerate(config.finalise_params):
+        for subj in params['subjlist']:
+            # skip this subject if nothing has changed since it was last finalised
+            manifest, key = finalise_key(subj, params)
+            if not artifacts.is_stale(manifest, key):
+                metadat[c][subj] = artifacts.read_manifest(manifest)['meta']
+                continue
+            stale.append((subj, params['suffix']))
+            if dry_run:
+                print("Would finalise: %s (%s)" % (subj, params['suffix']))
+                continue
+            todo.setdefault(subj, []).append((c, manifest, key))
+
+    if dry_run:
+        return stale
+
+    # load each subject just once and make the outputs of every set from that, many subjects at once
+    status = map_subjects(finalise_batch, list(todo), n_workers=n_workers, log_name='finalise', args=(todo,))
+    for s in status:
+        if s['ok']:
+            for c, meta in s['result'].items():
+                metadat[c][s['subj']] = meta
+        else:
+            print('{} failed, see {}'.format(s['subj'], s['log']))
+            print(s['error'])
+
+    # store the metadata for each set as a CSV (subjects that failed get an empty row)
+    for c, params in enumerate(config.finalise_params):
+        metadat_pd = pd.DataFrame([metadat[c].get(subj, {}) for subj in params['subjlist']])
+        csv_name = op.join(config.evoked_path, params['suffix'] + '_log.csv')
+        metadat_pd.to_csv(csv_name)
+
+    return stale
+
+# finalise one subject (in a worker) for all the sets they need
+def finalise_batch(subj, todo):
+    return finalise_subject(subj, todo[subj])
+
+# the manifest of a subject's outputs for one set, and the key of everything that went into them
+def finalise_key(subj, params):
+    subj_file = op.join(config.epoch_path, subj + '-epo.fif')
+    # everything in this set apart from the subject list affects each subject's output
+    set_params = {k: v for k, v in params.items() if k != 'subjlist'}
+    if is_streamed(params):
+        set_params['finalise_block'] = config.finalise_block
+    manifest = artifacts.manifest_fname(config.evoked_path, subj + '_' + params['suffix'])
+    key = artifacts.fingerprint(sources=[subj_file], params=set_params,
+                                code=[finalise_subject, finalise_set, diff_name, is_streamed, averaging,
+                                      filterbank_envelopes, filterbank_key, filtering])
+    return manifest, key
+
+# load and interpolate a subject once, then make the outputs of each of the (set, manifest, key) in sets
+def finalise_subject(subj, sets):
+    # find the data (the epochs are only read from disk when they are needed)
+    subj_file = op.join(config.epoch_path, subj + '-epo.fif')
+    print("Loading subject: %s" % subj_file)
+    epochs = mne.read_epochs(subj_file, preload=False)
+    # store the number of bad channels for reporting
+    nbads = len(epochs.info['bads'])
+
+    streamed = [is_streamed(config.finalise_params[c]) for c, _, _ in sets]
+    if all(streamed):
+        # no need to load it all, the bad channels are interpolated a block of epochs at a time
+        epochs_interp, envelopes = None, {}
+    else:
+        epochs_interp = epochs.copy().load_data()
+        # get rid of all bad channel info as this confuses stats later
+        epochs_interp.interpolate_bads(reset_bads=True)
+        # the bandpower of all the filter bank sets comes from one transform of the data
+        envelopes = filterbank_envelopes(epochs_interp, [config.finalise_params[c] for c, _, _ in sets])
+    interp = averaging.interpolation_matrix(epochs.info) if any(streamed) else None
+
+    metadat = {}
+    for c, manifest, key in sets:
+        params = config.finalise_params[c]
+        if is_streamed(params):
+            outputs, naves = finalise_set(epochs, subj, params, interp=interp)
         else:
-            # assumes method will be set as either mean or median
-            avg_method = config.finalise_params[c]['avg_method']          
-        # loop through subjects
-        for subj in subjlist:   
-            # find and load the data
-            condnames = config.finalise_params[c]['condnames']
-            subj_file = op.join(config.epoch_path, subj + '-epo.fif')
-            print("Loading subject: %s" % subj_file)
-            epochs = mne.read_epochs(subj_file)
-            # store the number of bad channels for reporting
-            metadat.append({'nbads': len(epochs.info['bads'])})
-            # get rid of all bad channel info as this confuses stats later
-            epochs.interpolate_bads(reset_bads=True)            
-            # separate out conditions of interest and create a file each
-            coi = []
-            for cond in condnames:
-                # select the current condition
-                cond_temp = epochs[cond]
-                # calculate bandpower if requested
-                if 'bandpower' in config.finalise_params[c]:
-                    l_freq, h_freq = config.finalise_params[c]['bandpower']
+            outputs, naves = finalise_set(epochs_interp, subj, params, envelopes)
+        metadat[c] = dict({'nbads': nbads}, **naves)
+        # remember what this subject was finalised from
+        artifacts.record(manifest, key, outputs, metadat[c])
+    return metadat
+
+# make the evoked (and bandpower epochs) of one set for a subject from their interpolated epochs,
+# or streamed from their epochs on disk if given the interpolation matrix interp,
+# returning the files saved and the number of trials in each condition
+def finalise_set(epochs, subj, params, envelopes=None, interp=None):
+    avg_method = averaging.get_avg_method(params['avg_method'])
+    outputs = []
+    naves = {}
+    # separate out conditions of interest and create a file each
+    coi = []
+    for cond in params['condnames']:
+        if interp is not None:
+            # average the data a block at a time
+            ev_temp = averaging.stream_average(epochs[cond], interp, params['avg_method'],
+                                               config.finalise_block, comment=cond)
+        else:
+            # select the current condition (this is a copy, so epochs is left as it is for the other sets)
+            cond_temp = epochs[cond]
+            # calculate bandpower if requested
+            if 'bandpower' in params:
+                l_freq, h_freq = params['bandpower']
+                if params.get('bandpower_method') == 'filterbank':
+                    # the envelopes were made for all the epochs, so just pick out this condition's
+                    picks, env = envelopes[filterbank_key(params)]
+                    cond_temp._data[:, picks] = env[np.searchsorted(epochs.selection, cond_temp.selection)]
+                else:
                     cond_temp.filter(l_freq=l_freq,h_freq=h_freq)
                     cond_temp.apply_hilbert(envelope=True)
-                    # save a version of this in case single-subject analysis wanted later
-                    tf_temp = cond_temp.copy()
-                    tf_temp.filter(l_freq=None,h_freq=config.finalise_params[c]['lo_pass'])
-                    tf_temp.apply_baseline(config.finalise_params[c]['base_win'])
-                    tf_save_name = (subj + '_' + config.finalise_params[c]['suffix'] + '_' + cond + '-epo.fif')
-                    tf_fname = op.join(config.epoch_path,tf_save_name)
-                    tf_temp.save(tf_fname)
-                # average the data              
-                ev_temp = cond_temp.average(method=avg_method)
-                # low pass filter the average
-                ev_temp.filter(l_freq=None,h_freq=config.finalise_params[c]['lo_pass'])
-                # baseline correct the data
-                ev_temp.apply_baseline(config.finalise_params[c]['base_win'])
-                # store number of trials in each average for later reporting
-                metadat[-1][cond] = ev_temp.nave
-                # store it in a list in case we want to subtract any conditions
-                coi.append(ev_temp.copy())                
-                # save it with a sensible name
-                save_name = (subj + '-epo_' + config.finalise_params[c]['suffix'] + '_' + cond + '-ave.fif')
-                fname = op.join(config.evoked_path,save_name)
-                ev_temp.save(fname)
-
-            # calculate subtractions of conditions if requested
-            ########
-    
-        # store the metadata as a CSV
-        metadat_pd = pd.DataFrame(metadat)
-        csv_name = op.join(config.evoked_path, config.finalise_params[c]['suffix'] + '_log.csv')
-        metadat_pd.to_csv(csv_name)
\ No newline at end of file
+            # average the data
+            ev_temp = cond_temp.average(method=avg_method)
+            if 'bandpower' in params:
+                # save a version of this in case single-subject analysis wanted later (now that we
+                # have the average, this can filter cond_temp itself rather than a copy of it)
+                cond_temp.filter(l_freq=None,h_freq=params['lo_pass'])
+                cond_temp.apply_baseline(params['base_win'])
+                tf_save_name = (subj + '_' + params['suffix'] + '_' + cond + '-epo.fif')
+                tf_fname = op.join(config.epoch_path,tf_save_name)
+                cond_temp.save(tf_fname)
+                outputs.append(tf_fname)
+            del cond_temp
+        # low pass filter the average
+        ev_temp.filter(l_freq=None,h_freq=params['lo_pass'])
+        # baseline correct the data
+        ev_temp.apply_baseline(params['base_win'])
+        # store number of trials in each average for later reporting
+        naves[cond] = ev_temp.nave
+        # store it in a list in case we want to subtract any conditions
+        coi.append(ev_temp.copy())
+        # save it with a sensible name
+        save_name = (subj + '-epo_' + params['suffix'] + '_' + cond + '-ave.fif')
+        fname = op.join(config.evoked_path,save_name)
+        ev_temp.save(fname)
+        outputs.append(fname)
+
+    # calculate subtractions of conditions if requested
+    for cond0, cond1 in params.get('subconds') or []:
+        # the averages are already filtered and baselined, so just subtract them
+        ev_diff = mne.combine_evoked([coi[params['condnames'].index(cond0)],
+                                      coi[params['condnames'].index(cond1)]], weights=[1, -1])
+        ev_diff.comment = diff_name(cond0, cond1)
+        save_name = (subj + '-epo_' + params['suffix'] + '_' + ev_diff.comment + '-ave.fif')
+        fname = op.join(config.evoked_path,save_name)
+        ev_diff.save(fname)
+        outputs.append(fname)
+
+    return outputs, naves
+
+# envelopes of the data channels in every band asked for by the filter bank sets, with one FFT of each
+# epoch and channel (per output precision)
+def filterbank_envelopes(epochs, sets):
+    wanted = {}
+    for params in sets:
+        if 'bandpower' in params and params.get('bandpower_method') == 'filterbank':
+            band, dtype = filterbank_key(params)
+            wanted.setdefault(dtype, set()).add(band)
+
+    envelopes = {}
+    picks = mne.pick_types(epochs.info, meg=True, eeg=True, seeg=True, ecog=True, exclude=[])
+    for dtype, bands in wanted.items():
+        bands = sorted(bands)
+        # straight from the loaded data, so the only copies made are of one block of epochs at a time
+        envs = hilbert_envelopes(epochs._data, epochs.info['sfreq'], bands, dtype=dtype, picks=picks)
+        for band, env in zip(bands, envs):
+            envelopes[band, dtype] = (picks, env)
+    return envelopes
+
+def filterbank_key(params):
+    return tuple(params['bandpower']), params.get('bandpower_dtype', 'float64')
+
+# the name (and evoked comment) of the difference between two conditions
+def diff_name(cond0, cond1):
+    return cond0 + '_minus_' + cond1
+
+# sets without bandpower can be averaged a block of epochs at a time, if finalise_block is set and
+# their average can be (the median can't, so those sets are loaded whole)
+def is_streamed(params):
+    return (bool(config.finalise_block) and 'bandpower' not in params
+            and params['avg_method'] in averaging.streamable)
@@ -0,0 +1,155 @@
+import os
+import os.path as op
+import sys
+import traceback
+import tempfile
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import eeg_pipeline.config as config
+
+# work out how many subjects we can process at once
+def get_n_workers(n_workers=None, mem_per_worker=None):
+    if n_workers is None:
+        n_workers = config.n_workers
+    if mem_per_worker is None:
+        mem_per_worker = config.mem_per_worker
+
+    # never use more workers than cores...
+    n_max = os.cpu_count() or 1
+    # ...or than we have memory for
+    mem_free = available_memory()
+    if mem_free is not None and mem_per_worker:
+        n_max = min(n_max, max(1, int(mem_free // (mem_per_worker * 1024**3))))
+
+    if n_workers is None:
+        return n_max
+    if n_workers > n_max:
+        print('Reducing n_workers from {} to {} to fit the available cores and memory'.format(n_workers, n_max))
+    return max(1, min(n_workers, n_max))
+
+# memory currently available to new processes, in bytes (None if we can't tell)
+def available_memory():
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+# run func(subj, *args) for every subject, using a pool of processes if we can
+def map_subjects(func, subjlist, n_workers=None, log_name=None, args=()):
+    n_workers = min(get_n_workers(n_workers), len(subjlist)) if subjlist else 1
+    results = {}
+    if n_workers == 1:
+        for n_done, subj in enumerate(subjlist, 1):
+            results[subj] = run_logged(func, subj, log_name, args)
+            print_progress(results[subj], n_done, len(subjlist))
+    else:
+        print('Processing {} subjects with {} workers'.format(len(subjlist), n_workers))
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = {pool.submit(run_logged, func, subj, log_name, args): subj for subj in subjlist}
+            for n_done, future in enumerate(as_completed(futures), 1):
+                subj = futures[future]
+                try:
+                    results[subj] = future.result()
+                except Exception:
+                    # the worker itself died (e.g. killed for using too much memory)
+                    results[subj] = {'subj': subj, 'ok': False, 'result': None,
+                                     'error': traceback.format_exc(), 'log': None, 'peak_rss_mb': None}
+                print_progress(results[subj], n_done, len(subjlist))
+
+    # hand back the results in the same order as the subjects went in
+    return [results[subj] for subj in subjlist]
+
+# report a finished subject on the console (everything else it printed went to its log)
+def print_progress(status, n_done, n_subj):
+    print('{}: {} ({} of {})'.format(status['subj'], 'done' if status['ok'] else 'FAILED', n_done, n_subj))
+
+# peak memory (resident set size) of this process in MB, since it started or since reset_peak_rss()
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kB, macOS bytes
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+# start measuring the peak memory afresh (only possible on linux)
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+# run func(subj, *args), sending everything it prints to the subject's log and catching any errors
+def run_logged(func, subj, log_name=None, args=()):
+    status = {'subj': subj, 'ok': False, 'result': None, 'error': None, 'log': None, 'peak_rss_mb': None}
+    if log_name is None:
+        log_file = None
+    else:
+        os.makedirs(config.log_path, exist_ok=True)
+        log_file = op.join(config.log_path, subj + '_' + log_name + '.log')
+        status['log'] = log_file
+
+    stdout, stderr = sys.stdout, sys.stderr
+    f = open(log_file, 'w', buffering=1) if log_file else None
+    try:
+        if f:
+            # MNE logs to whatever sys.stdout currently is, so this catches its output too
+            sys.stdout = sys.stderr = f
+        reset_peak_rss()
+        status['result'] = func(subj, *args)
+        status['ok'] = True
+    except Exception:
+        status['error'] = traceback.format_exc()
+        print(status['error'])
+    finally:
+        status['peak_rss_mb'] = peak_rss_mb()
+        if f:
+            sys.stdout, sys.stderr = stdout, stderr
+            f.close()
+    return status
+
+# while in this context, data bigger than share_min_size that mne hands to its parallel workers
+# (e.g. for permutations) is memory-mapped from a shared folder rather than copied to every worker
+@contextmanager
+def shared_memory(path=None, min_size=None):
+    if path is None:
+        path = config.share_path
+    if path is None:
+        # /dev/shm is held in RAM, so nothing is actually written to disk
+        path = '/dev/shm' if op.isdir('/dev/shm') else tempfile.gettempdir()
+    if min_size is None:
+        min_size = config.share_min_size
+
+    # mne reads these from the environment before its own config file
+    new = {'MNE_CACHE_DIR': path, 'MNE_MEMMAP_MIN_SIZE': min_size}
+    old = {k: os.environ.get(k) for k in new}
+    os.environ.update(new)
+    try:
+        yield path
+    finally:
+        for k, v in old.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
@@ -0,0 +1,320 @@
+import numpy as np
+from scipy import sparse, stats
+from scipy.sparse.csgraph import connected_components
+
+# Independent-samples t-tests from sufficient statistics. Swapping labels between the two samples
+# doesn't change the pooled data, only which rows are summed into which sample, so after the sums
+# of the pooled data are found once every permutation only needs the sums of one sample: a single
+# matrix product for a whole batch of permutations.
+
+# t values of a against b (observations * tests), as scipy.stats.ttest_ind (a drop-in mne stat_fun)
+def ttest_ind_no_p(a, b, equal_var=True):
+    X = np.concatenate([a, b])
+    labels = np.zeros((1, len(X)))
+    labels[0, :len(a)] = 1
+    return ttest_ind_labels(X, labels, equal_var)[0]
+
+# Welch's t (unequal variances) as an mne stat_fun
+def welch_ttest_no_p(a, b):
+    return ttest_ind_no_p(a, b, equal_var=False)
+
+# t values for each of a batch of permutations (n_perms * observations) of the pooled observations X,
+# where, as mne does, the first n0 of each permuted order make up the first sample
+def ttest_ind_perms(X, orders, n0, equal_var=True):
+    orders = np.atleast_2d(orders)
+    labels = np.zeros(orders.shape)
+    np.put_along_axis(labels, orders[:, :n0], 1, axis=1)
+    return ttest_ind_labels(X, labels, equal_var)
+
+# t values for each row of labels (n_perms * observations), which is 1 for the observations in the
+# first sample and 0 for those in the second; returns n_perms * the shape of a single observation
+def ttest_ind_labels(X, labels, equal_var=True):
+    shape = X.shape[1:]
+    X = X.reshape(len(X), -1)
+    n0 = labels.sum(axis=1)[:, np.newaxis]
+    n1 = len(X) - n0
+
+    # the sums of the pooled data (centred first, so the sums of squares lose less precision)
+    X = X - X.mean(axis=0)
+    sum_all = X.sum(axis=0)
+    sq_all = (X ** 2).sum(axis=0)
+    # the sums of the first sample of every permutation at once; the second has the rest
+    sum0 = labels @ X
+    sq0 = labels @ (X ** 2)
+    sum1 = sum_all - sum0
+    sq1 = sq_all - sq0
+
+    # sums of squared deviations from each sample's mean
+    ss0 = sq0 - sum0 ** 2 / n0
+    ss1 = sq1 - sum1 ** 2 / n1
+    diff = sum0 / n0 - sum1 / n1
+    if equal_var:
+        # Student: pooled variance
+        var = (ss0 + ss1) / (n0 + n1 - 2) * (1. / n0 + 1. / n1)
+    else:
+        # Welch: separate variances
+        var = ss0 / ((n0 - 1) * n0) + ss1 / ((n1 - 1) * n1)
+    return (diff / np.sqrt(var)).reshape((len(labels),) + shape)
+
+# one-sample t values of each of a batch of sign flips (n_perms * observations, of +/-1) of X;
+# flipping signs doesn't change the sums of squares, so only the sums need recomputing
+def ttest_1samp_signs(X, signs):
+    shape = X.shape[1:]
+    X = X.reshape(len(X), -1)
+    n = len(X)
+    sq = (X ** 2).sum(axis=0)
+    mean = signs @ X / n
+    var = (sq - n * mean ** 2) / (n - 1)
+    return (mean / np.sqrt(var / n)).reshape((len(signs),) + shape)
+
+# Threshold-free cluster enhancement (Smith & Nichols, 2009). Every point's score is the sum over
+# thresholds h (start, start + step, ...) below its value of extent^e_power * h^h_power * step, where
+# extent is the size of the cluster it is in at that threshold.
+#
+# Rather than finding the clusters afresh at each threshold, the points are added from the highest
+# threshold down, merging clusters as they touch (union-find). A cluster's size only changes when it
+# merges, so its contribution since then is added in one go from a running sum over the thresholds,
+# and points inherit the contributions of the clusters they were merged into through the tree.
+
+# the (i, j) pairs of neighbouring points of times * chans data: neighbouring channels at the same
+# time (from the channel adjacency) and the same channel at neighbouring times
+def neighbour_pairs(n_times, n_chans, adjacency):
+    adjacency = sparse.coo_matrix(adjacency)
+    upper = adjacency.row < adjacency.col
+    ch_i, ch_j = adjacency.row[upper], adjacency.col[upper]
+    offsets = np.arange(n_times)[:, np.newaxis] * n_chans
+    space_i = (offsets + ch_i).ravel()
+    space_j = (offsets + ch_j).ravel()
+    time_i = np.arange((n_times - 1) * n_chans)
+    time_j = time_i + n_chans
+    return np.concatenate([space_i, time_i]), np.concatenate([space_j, time_j])
+
+# TFCE scores of a times * chans map of statistics; positive and negative values are enhanced
+# separately (as mne does for two-tailed tests) and the scores keep the sign of the statistic
+def tfce(stat, pairs, start=0, step=0.2, e_power=0.5, h_power=2, tail=0):
+    start, step = abs(start), abs(step)
+    x = stat.ravel()
+    scores = np.zeros(x.size)
+    if tail in (0, 1):
+        scores += tfce_1sign(x, pairs, start, step, e_power, h_power)
+    if tail in (0, -1):
+        scores -= tfce_1sign(-x, pairs, start, step, e_power, h_power)
+    return scores.reshape(stat.shape)
+
+def tfce_1sign(x, pairs, start, step, e_power, h_power):
+    # the highest threshold each point is above (x > h, as mne), -1 if it's below them all
+    level = np.ceil((x - start) / step).astype(int) - 1
+    scores = np.zeros(x.size)
+    n_levels = level.max() + 1
+    if n_levels <= 0:
+        return scores
+
+    # what every cluster gets per unit extent at each threshold, summed from the top threshold down to
+    # each (so the sum over thresholds lo..hi is above[lo] - above[hi + 1])
+    h = start + step * np.arange(n_levels)
+    above = np.zeros(n_levels + 1)
+    above[:-1] = np.cumsum((h ** h_power * step)[::-1])[::-1]
+
+    # every point starts as a cluster of its own at its own threshold, and the pairs of neighbouring
+    # points join their clusters at the lower of their two, so go through the pairs from the top down
+    points = np.flatnonzero(level >= 0).tolist()
+    pair_level = np.minimum(level[pairs[0]], level[pairs[1]])
+    keep = pair_level >= 0
+    pair_i, pair_j, pair_level = pairs[0][keep], pairs[1][keep], pair_level[keep]
+    order = np.argsort(-pair_level, kind='stable')
+    pair_i, pair_j, pair_level = pair_i[order].tolist(), pair_j[order].tolist(), pair_level[order].tolist()
+
+    parent = list(range(x.size))
+    size = [1] * x.size
+    since = level.tolist()      # the threshold a cluster has had its current size since
+    acc = [0.] * x.size         # contributions, relative to the parent's (the total is the sum up the tree)
+    above = above.tolist()
+
+    def find(p):
+        path = []
+        while parent[p] != p:
+            path.append(p)
+            p = parent[p]
+        # point everything on the path straight at the root, keeping their sums
+        total = 0.
+        for q in reversed(path):
+            total += acc[q]
+            acc[q] = total
+            parent[q] = p
+        return p
+
+    for a, b, lev in zip(pair_i, pair_j, pair_level):
+        # merge the clusters that touch at this threshold (union by size keeps the trees shallow,
+        # so the roots are found without the bookkeeping of shortening the paths)
+        while parent[a] != a:
+            a = parent[a]
+        while parent[b] != b:
+            b = parent[b]
+        if a == b:
+            continue
+        # add what each has gathered at its old size
+        acc[a] += size[a] ** e_power * (above[lev + 1] - above[since[a] + 1])
+        acc[b] += size[b] ** e_power * (above[lev + 1] - above[since[b] + 1])
+        if size[a] < size[b]:
+            a, b = b, a
+        parent[b] = a
+        acc[b] -= acc[a]
+        size[a] += size[b]
+        since[a] = lev
+
+    # add what each final cluster has gathered since its last merge, then sum up the tree
+    roots = [p for p in points if parent[p] == p]
+    for r in roots:
+        acc[r] += size[r] ** e_power * (above[0] - above[since[r] + 1])
+    for p in points:
+        r = find(p)
+        scores[p] = acc[p] if p == r else acc[p] + acc[r]
+    return scores
+
+# Permutation tests of observations * times * chans data, returning what mne's
+# spatio_temporal_cluster(_1samp)_test return. The permutations are all drawn from the seed up front
+# (the first is the data as they are, as in mne) and their t maps are made a block at a time, as many
+# as fit in max_mem GB, each block with one matrix product.
+#
+# Given a confidence, they stop early (in the spirit of Besag & Clifford's sequential tests) once the
+# decision of every p-value against alpha is settled: when, with that confidence, it is either below
+# or above alpha given the permutations so far. H0 then only holds the permutations that were used.
+
+# sign flips (n_permutations * n_obs of +/-1) for a one-sample test; all of them if there are no
+# more than n_permutations, as mne does (in random order after the first, in case of stopping early).
+# Flipping every sign only flips the sign of the statistic, which a two-tailed test ignores, so then
+# the last observation keeps its sign and half as many flips cover them all.
+def sign_flips(n_obs, n_permutations, rng, tail=0):
+    n_free = n_obs - (tail == 0)
+    if 2 ** n_free <= n_permutations:
+        signs = np.ones((2 ** n_free, n_obs))
+        signs[:, :n_free] -= 2 * ((np.arange(2 ** n_free)[:, np.newaxis] >> np.arange(n_free)) & 1)
+        signs[1:] = signs[1 + rng.permutation(len(signs) - 1)]
+        return signs
+    signs = rng.choice([-1., 1.], size=(n_permutations, n_obs))
+    signs[0] = 1
+    return signs
+
+# how many permutations of n_tests t values fit in max_mem GB (a few arrays of n_tests per permutation)
+def perm_block_size(n_tests, max_mem):
+    return max(1, int(max_mem * 1024 ** 3 // (10 * 8 * n_tests)))
+
+# the permutations of X ([data] for a one-sample test, [data0, data1] for an independent one) and a
+# function giving the t maps of a block of them
+def t_permutations(X, n_permutations, rng, equal_var=True, tail=0):
+    if len(X) == 1:
+        data = X[0]
+        perms = sign_flips(len(data), n_permutations, rng, tail)
+        return perms, lambda block: ttest_1samp_signs(data, block)
+    data = np.concatenate(X)
+    perms = np.array([np.arange(len(data))] + [rng.permutation(len(data)) for _ in range(n_permutations - 1)])
+    return perms, lambda block: ttest_ind_perms(data, block, len(X[0]), equal_var)
+
+def check_rng(seed):
+    return seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
+
+# the blocks of permutations to go through; smaller ones when stopping early, so it can stop sooner
+def perm_blocks(n_perms, block_size, confidence=None, check_every=100):
+    if confidence is not None:
+        block_size = min(block_size, check_every)
+    return [slice(start, min(start + block_size, n_perms)) for start in range(0, n_perms, block_size)]
+
+# the p-value of each observed statistic against the largest (smallest for tail -1) of each permutation
+def perm_p_values(H0, observed, tail):
+    return exceedances(H0, observed, tail) / len(H0)
+
+def exceedances(H0, observed, tail):
+    if tail == -1:
+        return (H0[:, np.newaxis] <= observed).sum(axis=0)
+    return (H0[:, np.newaxis] >= np.abs(observed)).sum(axis=0)
+
+# whether, after n permutations, each of which was at least as extreme as an observed statistic
+# exceed times, it is clear with this confidence which side of alpha every p-value is on
+# (Clopper-Pearson intervals of the proportions)
+def decided(exceed, n, alpha, confidence):
+    exceed = np.asarray(exceed)
+    tails = (1 - confidence) / 2
+    lo = np.where(exceed > 0, stats.beta.ppf(tails, np.maximum(exceed, 1), n - exceed + 1), 0)
+    hi = np.where(exceed < n, stats.beta.ppf(1 - tails, exceed + 1, np.maximum(n - exceed, 1)), 1)
+    return bool(np.all((hi < alpha) | (lo > alpha)))
+
+# A TFCE test, with every point as a cluster of its own and its p-value against the largest score of
+# each permutation (H0). X is [data] (the signs are flipped) or [data0, data1] (the labels are swapped).
+def tfce_test(X, adjacency, threshold, n_permutations=1000, tail=0, seed=None, equal_var=True, max_mem=.5,
+              alpha=.05, confidence=None):
+    n_times, n_chans = X[0].shape[1:]
+    if adjacency is None:
+        adjacency = sparse.csr_matrix((n_chans, n_chans))
+    pairs = neighbour_pairs(n_times, n_chans, adjacency)
+    settings = dict(start=threshold.get('start', 0), step=threshold['step'],
+                    e_power=threshold.get('e_power', .5), h_power=threshold.get('h_power', 2), tail=tail)
+
+    perms, t_block = t_permutations(X, n_permutations, check_rng(seed), equal_var, tail)
+    H0 = np.zeros(len(perms))
+    for block in perm_blocks(len(perms), perm_block_size(n_times * n_chans, max_mem), confidence):
+        for i, stat in enumerate(t_block(perms[block]), block.start):
+            scores = tfce(stat, pairs, **settings)
+            if i == 0:
+                T_obs, obs_scores = stat, scores.ravel()
+            H0[i] = scores.min() if tail == -1 else np.abs(scores).max()
+        n_used = block.stop
+        if confidence is not None and decided(exceedances(H0[:n_used], obs_scores, tail), n_used, alpha,
+                                              confidence):
+            break
+
+    # each point's p-value is the proportion of permutations scoring at least as high anywhere
+    H0 = H0[:n_used]
+    p_values = perm_p_values(H0, obs_scores, tail)
+    clusters = [(np.array([t]), np.array([ch])) for t, ch in np.ndindex(n_times, n_chans)]
+    return T_obs, clusters, p_values, H0
+
+# A cluster-mass test: clusters are neighbouring points with t beyond the threshold (of the same
+# sign), scored by the sum of their t values, and each gets its p-value against the largest mass of
+# each permutation (H0). X is [data] (the signs are flipped) or [data0, data1] (the labels are swapped).
+def cluster_test(X, adjacency, threshold, n_permutations=1000, tail=0, seed=None, equal_var=True, max_mem=.5,
+                 alpha=.05, confidence=None):
+    n_times, n_chans = X[0].shape[1:]
+    if adjacency is None:
+        adjacency = sparse.csr_matrix((n_chans, n_chans))
+    pairs = neighbour_pairs(n_times, n_chans, adjacency)
+
+    perms, t_block = t_permutations(X, n_permutations, check_rng(seed), equal_var, tail)
+    H0 = np.zeros(len(perms))
+    for block in perm_blocks(len(perms), perm_block_size(n_times * n_chans, max_mem), confidence):
+        t_maps = t_block(perms[block])
+        labels, mass = cluster_masses(t_maps.reshape(len(t_maps), -1), pairs, threshold, tail)
+        if block.start == 0:
+            T_obs, obs_labels, obs_mass = t_maps[0], labels[0], mass[0]
+            # the clusters of the data as they are, as (time, channel) indices
+            clusters, cluster_mass = [], []
+            for label in np.unique(obs_labels[obs_mass != 0]):
+                points = np.flatnonzero(obs_labels == label)
+                clusters.append(np.unravel_index(points, (n_times, n_chans)))
+                cluster_mass.append(obs_mass[points[0]])
+            cluster_mass = np.array(cluster_mass)
+        H0[block] = mass.min(axis=1) if tail == -1 else np.abs(mass).max(axis=1)
+        n_used = block.stop
+        if confidence is not None and decided(exceedances(H0[:n_used], cluster_mass, tail), n_used, alpha,
+                                              confidence):
+            break
+
+    H0 = H0[:n_used]
+    return T_obs, clusters, perm_p_values(H0, cluster_mass, tail), H0
+# label the clusters of a block of t maps (n_maps * points) all at once, as the connected parts of one
+# graph of the neighbouring points that are both beyond the threshold (with the same sign) in a map;
+# returns each point's cluster label and the mass of its cluster (0 if it isn't in one)
+def cluster_masses(stats, pairs, threshold, tail):
+    n_maps, n_points = stats.shape
+    sign = np.zeros(stats.shape, dtype=np.int8)
+    if tail >= 0:
+        sign[stats > abs(threshold)] = 1
+    if tail <= 0:
+        sign[stats < -abs(threshold)] = -1
+    sign_i, sign_j = sign[:, pairs[0]], sign[:, pairs[1]]
+    maps, edges = np.nonzero((sign_i == sign_j) & (sign_i != 0))
+    graph = sparse.coo_matrix((np.ones(len(edges), dtype=np.int8),
+                               (maps * n_points + pairs[0][edges], maps * n_points + pairs[1][edges])),
+                              shape=(stats.size, stats.size))
+    _, labels = connected_components(graph, directed=False)
+    mass = np.bincount(labels, weights=np.where(sign != 0, stats, 0).ravel())
+    return labels.reshape(stats.shape), mass[labels].reshape(stats.shape)
@@ -1,77 +1,324 @@
+import os
 import os.path as op
 import numpy as np
 import mne
 import matplotlib.pyplot as plt
 from scipy import stats
 import eeg_pipeline.config as config
+from eeg_pipeline.parallel import map_subjects, peak_rss_mb
+import eeg_pipeline.artifacts as artifacts
+from eeg_pipeline.filtering import bandpass_raw, bandpass_decim
+import eeg_pipeline.filtering as filtering
+import eeg_pipeline.classify_ica as classify_ica
+
+# the phases of preprocessing, in order, with the preproc_params and the functions (or whole modules)
+# that each one depends on (each phase also depends on the raw file and on every phase before it)
+phases = (
+    # filter and fake-epoch a copy of the data for ICA
+    ('ica_epochs', (), ('load_raw', 'make_ica_epochs', 'filtering')),
+    # find the big bad stuff before ICA
+    ('bad_data', ('z_thresh', 'hurst'), ('find_bad_data', 'hurst_exponents', 'chan_mean')),
+    # fit the ICA
+    ('ica', ('ica_method', 'ica_fit_params', 'ica_n_components', 'ica_decim'),
+        ('drop_bad_data', 'fit_ica', 'ica_settings')),
+    # pick the components to remove
+    ('components', ('ica_select', 'ica_auto_thresh'), ('select_components', 'classify_ica')),
+    # create the final epochs
+    ('epochs', ('hi_pass', 'lo_pass', 'epoch_win', 'base_win', 'z_thresh', 'hurst', 'ica_select'),
+        ('load_raw', 'make_epochs', 'filtering', 'find_bad_data', 'hurst_exponents', 'chan_mean')),
+)
+phase_names = [p[0] for p in phases]
 
 # the main preprocess function
-def preprocess(subjname):    
-    # import the data
+def preprocess(subjname, stop_after=None, dry_run=False, rerun_from=None):
+    # work out which phases are already done and can be skipped
+    keys = phase_keys(subjname)
+    done = read_checkpoints(subjname)
+    if rerun_from is not None:
+        # redo this phase and every one after it even if nothing has changed (e.g. rerun_from='components'
+        # to pick the components again)
+        for p in phase_names[phase_names.index(rerun_from):]:
+            done['keys'].pop(p, None)
+    stale = [p for p in phase_names if not is_done(subjname, p, keys, done)]
+    if stop_after is not None:
+        stale = [p for p in stale if phase_names.index(p) <= phase_names.index(stop_after)]
+    if not stale:
+        print('%s is up to date with the current settings' % subjname)
+        # a dry run always returns the phases it would rerun (here none)
+        return [] if dry_run else done
+    if dry_run:
+        # just report what would be recomputed
+        print('%s would rerun: %s' % (subjname, ', '.join(stale)))
+        return stale
+    print('%s: resuming from the %s phase' % (subjname, stale[0]))
+
+    os.makedirs(config.ica_path, exist_ok=True)
+    ica_fname, ica_epo_fname = checkpoint_fnames(subjname)
+    raw, epochs_4_ica, ica = None, None, None
+
+    try:
+        # filter and fake-epoch the raw copy for ICA
+        if 'ica_epochs' in stale:
+            raw = load_raw(subjname)
+            epochs_4_ica = make_ica_epochs(raw)
+            epochs_4_ica.save(ica_epo_fname, overwrite=True)
+            done = checkpoint(subjname, done, 'ica_epochs', keys)
+
+        # auto reject big bad stuff before ICA
+        if 'bad_data' in stale:
+            if epochs_4_ica is None:
+                epochs_4_ica = mne.read_epochs(ica_epo_fname)
+            eeg_picks = mne.pick_types(epochs_4_ica.info, eeg=True, exclude=[])
+            bad_chans, bad_trials = find_bad_data(epochs_4_ica.get_data(picks=eeg_picks))
+            done['bad_chans'] = [epochs_4_ica.info['ch_names'][eeg_picks[i]] for i in bad_chans]
+            done['bad_trials'] = [int(i) for i in bad_trials]
+            done = checkpoint(subjname, done, 'bad_data', keys)
+
+        # run ICA on the copy
+        if 'ica' in stale:
+            if epochs_4_ica is None:
+                epochs_4_ica = mne.read_epochs(ica_epo_fname)
+            drop_bad_data(epochs_4_ica, done)
+            ica = fit_ica(epochs_4_ica)
+            ica.save(ica_fname)
+            done = checkpoint(subjname, done, 'ica', keys)
+
+        # identify bad components, by eye and/or automatically
+        select = config.preproc_params.get('ica_select', 'manual')
+        if 'components' in stale:
+            if ica is None:
+                ica = mne.preprocessing.read_ica(ica_fname)
+            if epochs_4_ica is None:
+                epochs_4_ica = mne.read_epochs(ica_epo_fname)
+                drop_bad_data(epochs_4_ica, done)
+            if select == 'manual':
+                done['exclude'] = select_components(ica, epochs_4_ica)
+            else:
+                exclude, done['ica_scores'] = classify_ica.classify_ica(ica, epochs_4_ica)
+                print('Automatically selected components {}'.format(exclude))
+                if select == 'review':
+                    exclude = select_components(ica, epochs_4_ica, suggested=exclude)
+                done['exclude'] = exclude
+            done = checkpoint(subjname, done, 'components', keys)
+
+        # now we create the true epoch set before applying the ica to that
+        if 'epochs' in stale:
+            if raw is None:
+                raw = load_raw(subjname)
+            if ica is None:
+                ica = mne.preprocessing.read_ica(ica_fname)
+            ica.exclude = list(done['exclude'])
+            epochs = make_epochs(raw, ica, done['bad_chans'], review=(select != 'auto'))
+
+            # save the data
+            fname = op.join(config.epoch_path, subjname + '-epo.fif')
+            epochs.save(fname, overwrite=True)
+            done = checkpoint(subjname, done, 'epochs', keys)
+    finally:
+        # tidy up, even if a phase failed, so a batch doesn't fill the scratch volume with raw copies
+        del raw
+        remove_scratch(subjname)
+
+    # report the memory we needed, so we know how many subjects can run at once
+    print('%s: peak memory use %.0f MB' % (subjname, peak_rss_mb() or 0))
+    return done
+
+# run the non-interactive phases for many subjects at once: up to and including the ICA fit,
+# or everything if the components are being picked automatically
+def preprocess_many(subjlist, n_workers=None, dry_run=False):
+    if dry_run:
+        return {subj: preprocess(subj, stop_after=batch_stop(), dry_run=True) for subj in subjlist}
+
+    status = map_subjects(prep_batch, subjlist, n_workers=n_workers, log_name='preprocess')
+
+    # tell the user how it went
+    failed = [s for s in status if not s['ok']]
+    print('{} ready for {} of {} subjects'.format('Epochs' if batch_stop() is None else 'ICA',
+                                               len(subjlist) - len(failed), len(subjlist)))
+    peaks = [s['peak_rss_mb'] for s in status if s['peak_rss_mb']]
+    if peaks:
+        print('Peak memory per subject: {:.0f} MB (mean {:.0f} MB)'.format(max(peaks), np.mean(peaks)))
+    for s in failed:
+        print('{} failed, see {}'.format(s['subj'], s['log']))
+        print(s['error'])
+    return status
+
+# preprocess a single subject as far as we can without asking the user anything
+def prep_batch(subjname):
+    return preprocess(subjname, stop_after=batch_stop())
+
+def batch_stop():
+    return None if config.preproc_params.get('ica_select', 'manual') == 'auto' else 'ica'
+
+# where the ICA and the epochs it was fit on are stored
+def checkpoint_fnames(subjname):
+    ica_fname = op.join(config.ica_path, subjname + '-ica.fif')
+    ica_epo_fname = op.join(config.ica_path, subjname + '_4ica-epo.fif')
+    return ica_fname, ica_epo_fname
+
+# work out the key of each phase from the raw files, the relevant parameters and the code
+def phase_keys(subjname):
+    raw_files = [op.join(config.raw_path, subjname + ext) for ext in ('.vhdr', '.vmrk', '.eeg')]
+    key = artifacts.fingerprint(sources=[f for f in raw_files if op.isfile(f)])
+
+    keys = {}
+    for phase, param_names, func_names in phases:
+        params = {p: config.preproc_params.get(p) for p in param_names}
+        if phase in ('ica_epochs', 'epochs'):
+            # the eye channels are set (and paired up for ICA) when the raw data are loaded
+            params['eog_chans'], params['eog_pairs'] = eog_chans, eog_pairs
+        if phase == 'epochs':
+            # the event names also end up in the final epochs
+            params['event_info'] = config.event_info
+        code = [globals()[f] for f in func_names]
+        key = artifacts.fingerprint(params=params, code=code, upstream=[key, phase])
+        keys[phase] = key
+    return keys
+
+# a phase is done if it was run with the same key and its output is still there
+def is_done(subjname, phase, keys, done):
+    if done['keys'].get(phase) != keys[phase]:
+        return False
+    ica_fname, ica_epo_fname = checkpoint_fnames(subjname)
+    outputs = {
+        'ica_epochs': [ica_epo_fname],
+        'ica': [ica_fname],
+        'epochs': [op.join(config.epoch_path, subjname + '-epo.fif')],
+    }
+    return all(op.isfile(f) for f in outputs.get(phase, []))
+
+def read_checkpoints(subjname):
+    done = artifacts.read_json(op.join(config.ica_path, subjname + '_preproc.json'))
+    return done or {'keys': {}}
+
+# record that a phase has finished, and forget any later phases that were run on the old output
+def checkpoint(subjname, done, phase, keys):
+    done['keys'][phase] = keys[phase]
+    for p in phase_names[phase_names.index(phase) + 1:]:
+        if done['keys'].get(p) != keys[p]:
+            done['keys'].pop(p, None)
+    artifacts.write_json(op.join(config.ica_path, subjname + '_preproc.json'), done)
+    return done
+
+# load the raw data and do the basic tidying
+def load_raw(subjname):
     fname = op.join(config.raw_path, subjname + '.vhdr')
     raw = mne.io.read_raw_brainvision(fname)
-    raw.load_data()
 
     # remove the first 15-seconds as this typically has filter artifacts
     raw.crop(15,None)
 
-    # remove channels we don't care about
-    raw.drop_channels(['HEOGR','HEOGL','VEOGU','VEOGL','M1','M2'])
+    # remove channels we don't care about, but keep the eye channels to help find eye components
+    raw.drop_channels(['M1','M2'])
+    raw.set_channel_types({ch: 'eog' for ch in eog_chans if ch in raw.ch_names})
+
+    # only now load the data we are keeping, either into RAM or into a memory-mapped scratch file
+    if config.memmap_path is None:
+        raw.load_data()
+    else:
+        os.makedirs(config.memmap_path, exist_ok=True)
+        raw._preload_data(scratch_fname(subjname))     # load_data() can't take a file name in this mne
 
     # get and import electrode locations
     raw.set_montage('standard_1005')
+    return raw
+
+# the eye channels, and the bipolar pairs we make from them
+eog_chans = ['HEOGR','HEOGL','VEOGU','VEOGL']
+eog_pairs = {'HEOG': ('HEOGR','HEOGL'), 'VEOG': ('VEOGU','VEOGL')}
 
-    # create copy for use in ICA
-    raw_4_ica = raw.copy()
+def scratch_fname(subjname):
+    return op.join(config.memmap_path, subjname + '_raw.dat')
 
-    # filter the raw copy for ICA
+def remove_scratch(subjname):
+    if config.memmap_path is not None and op.isfile(scratch_fname(subjname)):
+        try:
+            os.remove(scratch_fname(subjname))
+        except OSError:
+            pass    # e.g. still mapped on windows; it will be overwritten next time
+
+# filter the raw data into a separate, decimated buffer and cut it into fake epochs for ICA
+def make_ica_epochs(raw):
     hi_pass, lo_pass = 1 , 40       # we hardcode these params for better ICA decomp
-    raw_4_ica.filter(hi_pass, None)
-    raw_4_ica.filter(None, lo_pass)
+    sfreq = 100                     # and run the ICA at this rate
+
+    # filter straight into a new buffer at (close to) the ICA rate rather than copying the raw first;
+    # the 40 Hz low pass means we can decimate down to 100 Hz without aliasing
+    decim = max(1, int(raw.info['sfreq'] // sfreq))
+    picks = mne.pick_types(raw.info, eeg=True, exclude=[])
+    data = bandpass_decim(raw, hi_pass, lo_pass, decim, picks)
+    info = mne.pick_info(raw.info, picks)
+    info['sfreq'] = raw.info['sfreq'] / decim
+    info['highpass'], info['lowpass'] = float(hi_pass), float(lo_pass)
+    raw_4_ica = mne.io.RawArray(data, info)
+
+    # add bipolar eye channels, filtered the same way, so we can spot eye components later
+    pairs = [pair for pair in eog_pairs.values() if all(ch in raw.ch_names for ch in pair)]
+    if pairs:
+        eog = bandpass_decim(raw, hi_pass, lo_pass, decim, [raw.ch_names.index(ch) for pair in pairs for ch in pair])
+        eog_names = [name for name, pair in eog_pairs.items() if pair in pairs]
+        eog_info = mne.create_info(eog_names, raw_4_ica.info['sfreq'], 'eog')
+        raw_4_ica.add_channels([mne.io.RawArray(eog[0::2] - eog[1::2], eog_info)], force_update_info=True)
+
+    # if the rate doesn't divide exactly, resample the (now small) data the rest of the way
+    if raw_4_ica.info['sfreq'] != sfreq:
+        raw_4_ica.resample(sfreq)
 
     # create fake epochs of the raw copy for ICA so we can reject big artifacts before decomp
-    fake_event_time = np.arange(0,raw.n_times,raw.info['sfreq'])        # fake event every 1-second
+    fake_event_time = np.arange(0,raw_4_ica.n_times,sfreq)              # fake event every 1-second
     fake_event_ids = np.tile(np.array([0,1]),(fake_event_time.size,1))  # mimic the last two columns of events
     fake_events = np.column_stack((fake_event_time,fake_event_ids))
     fake_events = fake_events.astype(int)       # needs to be an array of integers
-    tmin, tmax = 0, (raw_4_ica.info['sfreq']-1)/raw_4_ica.info['sfreq']
-    epochs_4_ica = mne.Epochs(raw_4_ica, events=fake_events, tmin=tmin, tmax=tmax, baseline=(tmin,tmax))
-
-    # identify bad data before running ICA
-    epochs_4_ica.load_data()
-    epochs_4_ica.resample(100)
-
-    # auto reject big bad stuff before ICA
-    epoch_data = epochs_4_ica.get_data()
-    bad_chans, bad_trials = find_bad_data(epoch_data)
-
-    epochs_4_ica.info['bads'] = [epochs_4_ica.info['ch_names'][i] for i in bad_chans]   
-    epochs_4_ica.drop(bad_trials,'AUTO')
-
-    # run ICA on the copy
+    tmin, tmax = 0, (sfreq-1)/sfreq
+    epochs_4_ica = mne.Epochs(raw_4_ica, events=fake_events, tmin=tmin, tmax=tmax, baseline=(tmin,tmax),
+                              preload=True)
+    return epochs_4_ica
+
+# mark the bad channels and drop the bad trials found before ICA
+def drop_bad_data(epochs_4_ica, done):
+    epochs_4_ica.info['bads'] = list(done['bad_chans'])
+    epochs_4_ica.drop(done['bad_trials'],'AUTO')
+
+# fit the ICA with the settings in preproc_params, or any given in settings instead
+def fit_ica(epochs_4_ica, settings=None, random_state=666):   # fixed random_state ensures same ICA each time
     from mne.preprocessing import ICA
-    method = 'fastica'
-    decim = 3 # make it faster...
-    random_state = 666 # ensures same ICA each time
-    ica = ICA(method=method, random_state=random_state).fit(epochs_4_ica, decim=decim)
-
-    # visually identify bad components
+    settings = dict(ica_settings(), **(settings or {}))
+    ica = ICA(method=settings['method'], fit_params=settings['fit_params'],
+              n_components=settings['n_components'], random_state=random_state)
+    return ica.fit(epochs_4_ica, decim=settings['decim'])
+
+def ica_settings():
+    return {
+        'method': config.preproc_params.get('ica_method', 'fastica'),
+        'fit_params': config.preproc_params.get('ica_fit_params'),
+        'n_components': config.preproc_params.get('ica_n_components'),   # None keeps full rank
+        'decim': config.preproc_params.get('ica_decim', 3),                 # make it faster...
+    }
+
+# ask the user which components to remove
+def select_components(ica, epochs_4_ica, suggested=None):
     ica.plot_components(range(0,9))     # plot only first 10 as have most variance
     comps2check = input("Indices of components to check, separated by commas [leave blank if none]:")
     if comps2check:
         comps2check_idx = list(map(int,comps2check.split(",")))
-        ica.plot_properties(raw_4_ica,comps2check_idx)
-
-    bad_comps_str = input("Indices of components to REJECT, separated by commas [leave blank if none]:")
+        ica.plot_properties(epochs_4_ica,comps2check_idx)
+
+    bad_comps_idx = []
+    if suggested is None:
+        bad_comps_str = input("Indices of components to REJECT, separated by commas [leave blank if none]:")
+    else:
+        # blank accepts the automatic suggestion
+        bad_comps_str = input("Indices of components to REJECT, separated by commas [leave blank for {}]:".format(suggested))
+        bad_comps_idx = list(suggested)
     if bad_comps_str:
         bad_comps_idx = list(map(int,bad_comps_str.split(",")))
-        ica.exclude.extend(bad_comps_idx)
         print('Removing components {}'.format(bad_comps_idx))
+    return bad_comps_idx
 
-    # now we create the true epoch set before applying the ica to that
+# create the final epochs from the raw data and clean them with the ICA
+def make_epochs(raw, ica, bad_chans, review=True):
     # filter the raw data
-    raw.filter(config.preproc_params['hi_pass'], None)
-    raw.filter(None, config.preproc_params['lo_pass'])
+    bandpass_raw(raw, config.preproc_params['hi_pass'], config.preproc_params['lo_pass'])
 
     # extract events - BV data has markers as annotations
     events, event_id = mne.events_from_annotations(raw)
@@ -98,7 +345,7 @@ def preprocess(subjname):
     epochs = mne.Epochs(raw, events=events, tmin=tmin, event_id=new_event_id, tmax=tmax, baseline=baseline, picks=picks)  
 
     # remove the bad channels identified earlier
-    epochs.info['bads'] = epochs_4_ica.info['bads']
+    epochs.info['bads'] = list(bad_chans)
 
     # apply the ICA from the raw copy to the epoched data
     epochs.load_data()
@@ -113,8 +360,9 @@ def preprocess(subjname):
     # baseline correct again as ICA will have affected
     epochs.apply_baseline()     # with no arguments this defaults to (None,0)
 
-    # would be good to plot and check here, but can at least plot it
-    epochs.plot(scalings=dict(eeg=20e-5),n_epochs=5,n_channels=len(epochs.info['chs']),block=True)    
+    # would be good to plot and check here, but can at least plot it (unless running unattended)
+    if review:
+        epochs.plot(scalings=dict(eeg=20e-5),n_epochs=5,n_channels=len(epochs.info['chs']),block=True)    
 
     # deal with any new bad channels or trials identified by user
     epochs.interpolate_bads(reset_bads=False)
@@ -126,52 +374,115 @@ def preprocess(subjname):
     # convert to average reference and update channel locations
     epochs.set_eeg_reference(ref_channels='average',projection=False)
     epochs.set_montage('standard_1005')
-
-    # save the data
-    fname = op.join(config.epoch_path, subjname + '-epo.fif')
-    epochs.save(fname, overwrite=True)
+    return epochs
 
 # function to automatically find bad data
-def find_bad_data(epoch_data):
+def find_bad_data(epoch_data, z_thresh=None, hurst=None, chunk_mb=64):
     # data arrives as epochs * chans * times
-    # we will follow the FASTER pipeline
-    z_thresh = 3
-    n_epochs = epoch_data.shape[0]
-    n_chans = epoch_data.shape[1]
-    n_times = epoch_data.shape[2]
-
-    epoch_data = np.moveaxis(epoch_data,1,0)        # make chans first dimension
-    epoch_data_reshape = np.reshape(epoch_data,(n_chans,n_epochs*n_times))
+    # we will follow the FASTER pipeline, working through the epochs in chunks of about chunk_mb
+    # so we never hold more than one extra chunk of data in memory
+    if z_thresh is None:
+        z_thresh = config.preproc_params.get('z_thresh', 3)
+    if not isinstance(z_thresh, dict):
+        # the same threshold for every criterion
+        z_thresh = dict.fromkeys(('ch_var', 'ch_corr', 'ch_hurst', 'ep_range', 'ep_var', 'ep_dev'), z_thresh)
+    if hurst is None:
+        hurst = config.preproc_params.get('hurst', False)
+    n_epochs, n_chans, n_times = epoch_data.shape
+    chunk = max(1, int(chunk_mb * 1024**2 // (n_chans * n_times * 8)))
+    chunks = [slice(i, min(i + chunk, n_epochs)) for i in range(0, n_epochs, chunk)]
+    n_samples = n_epochs * n_times
+
+    # first pass: mean of each channel
+    ch_mean = np.zeros(n_chans)
+    for ep in chunks:
+        ch_mean += epoch_data[ep].sum(axis=(0, 2))
+    ch_mean /= n_samples
+
+    # second pass: channel covariance, from which we get both the variance and correlations
+    ch_cov = np.zeros((n_chans, n_chans))
+    for ep in chunks:
+        dat = epoch_data[ep] - ch_mean[:, np.newaxis]
+        ch_cov += np.tensordot(dat, dat, axes=([0, 2], [0, 2]))
+    ch_var = np.diag(ch_cov) / n_samples
+    ch_sd = np.sqrt(np.diag(ch_cov))
+    ch_corr = np.clip(ch_cov / ch_sd[:, np.newaxis] / ch_sd[np.newaxis, :], -1, 1)
 
     # abs zscore of variance for each channel
-    ch_var = np.where(np.abs(stats.zscore(np.var(epoch_data_reshape, axis=1))) > z_thresh)[0]
+    ch_var = np.where(np.abs(stats.zscore(ch_var)) > z_thresh['ch_var'])[0]
     # abs zscore of mean correlation with other channels
-    ch_corr = np.where(np.abs(stats.zscore(np.mean(np.corrcoef(epoch_data_reshape),axis=0))) > z_thresh)[0]
-    # # abs zscore of hurst exponents - this is restrictively slow so we won't bother...
-    # from hurst import compute_Hc
-    # ch_hurst = []
-    # for ch in range(0,n_chans):
-    #     print(ch)
-    #     H = compute_Hc(epoch_data_reshape[ch,:], kind='change', simplified=True)[0]
-    #     ch_hurst.append(H)
-    # ch_hurst = np.where(np.abs(stats.zscore(ch_hurst)))
-
-    bad_chans = np.unique(np.concatenate((ch_var,ch_corr),axis=0))
+    ch_corr = np.where(np.abs(stats.zscore(np.mean(ch_corr, axis=0))) > z_thresh['ch_corr'])[0]
+
+    # abs zscore of hurst exponents, with the channels concatenated over epochs a few at a time
+    ch_hurst = np.array([], dtype=int)
+    if hurst:
+        ch_block = max(1, int(chunk_mb * 1024**2 // (n_samples * 8)))
+        h = np.zeros(n_chans)
+        for ch in range(0, n_chans, ch_block):
+            chs = slice(ch, min(ch + ch_block, n_chans))
+            ch_data = epoch_data[:, chs, :].transpose(1, 0, 2).reshape(-1, n_samples)
+            h[chs] = hurst_exponents(ch_data)
+        # channels where it can't be estimated at all are flat, and so bad
+        finite = np.isfinite(h)
+        h_z = np.zeros(n_chans)
+        h_z[finite] = stats.zscore(h[finite])
+        ch_hurst = np.where((np.abs(h_z) > z_thresh['ch_hurst']) | ~finite)[0]
+
+    bad_chans = np.unique(np.concatenate((ch_var,ch_corr,ch_hurst),axis=0))
     good_chans = np.setdiff1d(np.arange(0,n_chans),bad_chans)
 
-    # ignore the bad_chans from now on
-    epoch_data_nobads = epoch_data[tuple(good_chans),:,:]
-
-    # subtract the mean of each epoch
-    epoch_data_nobads = epoch_data_nobads - np.moveaxis(np.tile(np.mean(epoch_data_nobads, axis=2),(n_times,1,1)),0,2)
-    # abs zscore of mean voltage ranges
-    ep_range = np.where(np.abs(stats.zscore(np.mean(np.ptp(epoch_data_nobads, axis=2), axis=0))) > z_thresh)[0]
-    # abs zscore of mean voltage variance
-    ep_var = np.where(np.abs(stats.zscore(np.mean(np.var(epoch_data_nobads, axis=2), axis=0))) > z_thresh)[0]
-    # abs zscore of mean deviation of channels from the mean
-    ep_dev = np.where(np.abs(stats.zscore(np.mean(np.mean(epoch_data_nobads, axis=2) - np.mean(np.mean(epoch_data_nobads, axis=2), axis=0), axis=0))) > z_thresh)[0]
+    # third pass: epoch statistics over the good channels only
+    ep_range, ep_var, ep_dev = np.zeros(n_epochs), np.zeros(n_epochs), np.zeros(n_epochs)
+    for ep in chunks:
+        dat = epoch_data[ep][:, good_chans, :]
+        dat_mean = np.mean(dat, axis=2)
+        # mean deviation of each channel's mean in the epoch from its mean over all epochs (FASTER's
+        # amplitude deviation; this has to come before the epochs are demeaned, when it would be 0)
+        ep_dev[ep] = chan_mean(dat_mean - ch_mean[good_chans])
+        # subtract the mean of each epoch
+        dat -= dat_mean[:, :, np.newaxis]
+        # mean voltage ranges
+        ep_range[ep] = chan_mean(np.ptp(dat, axis=2))
+        # mean voltage variance
+        ep_var[ep] = chan_mean(np.var(dat, axis=2))
+
+    # abs zscores of the above
+    ep_range = np.where(np.abs(stats.zscore(ep_range)) > z_thresh['ep_range'])[0]
+    ep_var = np.where(np.abs(stats.zscore(ep_var)) > z_thresh['ep_var'])[0]
+    ep_dev = np.where(np.abs(stats.zscore(ep_dev)) > z_thresh['ep_dev'])[0]
 
     bad_trials = np.unique(np.concatenate((ep_range,ep_var,ep_dev),axis=0))
-    # good_trials = np.setdiff1d(np.arange(0,n_epochs),bad_trials)
 
-    return bad_chans, bad_trials
\ No newline at end of file
+    return bad_chans, bad_trials
+
+# Hurst exponent of each row of a chans * samples array, all channels at once
+# (this is the simplified rescaled range analysis of hurst.compute_Hc(kind='change'))
+def hurst_exponents(data, min_window=10):
+    n_chans, n_samples = data.shape
+    window_sizes = [int(10**x) for x in np.arange(np.log10(min_window), np.log10(n_samples - 1), 0.25)]
+    window_sizes.append(n_samples)
+
+    log_rs = np.zeros((n_chans, len(window_sizes)))
+    for i, w in enumerate(window_sizes):
+        # split every channel into as many whole windows of this size as will fit
+        n_win = n_samples // w
+        win = data[:, :n_win * w].reshape(n_chans, n_win, w)
+        # range of the cumulative sum (starting from zero) over the standard deviation
+        walk = np.cumsum(win, axis=2)
+        R = np.maximum(walk.max(axis=2), 0) - np.minimum(walk.min(axis=2), 0)
+        S = np.std(win, axis=2, ddof=1)
+        # windows where R/S is undefined are skipped
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rs = np.where((R == 0) | (S == 0), np.nan, R / S)
+            log_rs[:, i] = np.log10(np.nanmean(rs, axis=1))
+
+    # slope of the log R/S against log window size
+    log_w = np.log10(window_sizes)
+    log_w = log_w - log_w.mean()
+    return np.sum(log_w * (log_rs - log_rs.mean(axis=1, keepdims=True)), axis=1) / np.sum(log_w ** 2)
+
+# average an epochs * chans array over channels, summing in channel order
+# (the same summation order as the original chans-first implementation, so the range and variance
+# statistics match it exactly)
+def chan_mean(x):
+    return np.mean(np.ascontiguousarray(x.T), axis=0)
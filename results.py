@@ -0,0 +1,93 @@
+import os
+import os.path as op
+import shutil
+import numpy as np
+import mne
+import eeg_pipeline.config as config
+import eeg_pipeline.artifacts as artifacts
+
+# The results of an analysis are kept in a folder named after it in the stats folder:
+#   meta.json      the settings, the source files and a summary of the clusters of each run
+#   run_000.npz    the arrays of each run (T_obs, p-values, H0 and the clusters as indices)
+#   run_000-ave.fif  the averages of each run, for plotting
+# The data themselves are not copied, they can be found again from the source files.
+
+def results_path(analysis_name):
+    return op.join(config.stat_path, analysis_name)
+
+# the arrays of a run, with each cluster's (time, channel) indices concatenated and split by cluster_ptr
+def pack_run(cluster_stats, good_cluster_inds):
+    T_obs, clusters, p_values, H0 = cluster_stats
+    clusters = [(np.atleast_1d(times), np.atleast_1d(chans)) for times, chans in clusters]
+    sizes = [len(times) for times, chans in clusters]
+    return {
+        'T_obs': T_obs,
+        'p_values': np.asarray(p_values),
+        'H0': np.asarray(H0),
+        'good_cluster_inds': np.asarray(good_cluster_inds, dtype=int),
+        'cluster_times': np.concatenate([np.zeros(0, int)] + [times for times, chans in clusters]).astype(int),
+        'cluster_chans': np.concatenate([np.zeros(0, int)] + [chans for times, chans in clusters]).astype(int),
+        'cluster_ptr': np.concatenate([[0], np.cumsum(sizes)]).astype(int),
+    }
+
+# write the runs of an analysis, each a dict with its 'arrays' (from pack_run), its 'evokeds'
+# ({name: evoked or None}) and the 'sources' it was run on
+def save_results(analysis_name, runs, params):
+    path = results_path(analysis_name)
+    # write everything to a new folder, then swap it in, so there is never half a set of results
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    os.makedirs(tmp_path)
+    meta = {'analysis': params, 'runs': []}
+    for statrun, run in enumerate(runs):
+        fname = 'run_%03d.npz' % statrun
+        np.savez(op.join(tmp_path, fname), **run['arrays'])
+        names = [name for name, ev in run['evokeds'].items() if ev is not None]
+        ev_fname = 'run_%03d-ave.fif' % statrun
+        mne.write_evokeds(op.join(tmp_path, ev_fname), [run['evokeds'][name] for name in names])
+        p_values = run['arrays']['p_values']
+        meta['runs'].append({
+            'file': fname,
+            'evokeds': ev_fname,
+            'evoked_names': names,
+            'sources': run['sources'],
+            'n_clusters': len(p_values),
+            'good_cluster_inds': [int(i) for i in run['arrays']['good_cluster_inds']],
+            'min_p': float(np.min(p_values)) if len(p_values) else None,
+            'seconds': run.get('seconds'),
+            'n_permutations': len(run['arrays']['H0']),
+        })
+    artifacts.write_json(op.join(tmp_path, 'meta.json'), meta)
+
+    if op.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp_path, path)
+    return op.join(path, 'meta.json')
+
+# the settings of an analysis and a summary of each run, without loading any of the arrays
+def read_meta(analysis_name):
+    return artifacts.read_json(op.join(results_path(analysis_name), 'meta.json'))
+
+# the arrays of one run; each is only read from disk when it is used (e.g. read_run(name)['p_values'])
+def read_run(analysis_name, statrun=0):
+    meta = read_meta(analysis_name)
+    return np.load(op.join(results_path(analysis_name), meta['runs'][statrun]['file']))
+
+# the time and channel indices of one cluster of a run
+def read_cluster(analysis_name, statrun, clu_idx):
+    run = read_run(analysis_name, statrun)
+    start, stop = run['cluster_ptr'][clu_idx:clu_idx + 2]
+    return run['cluster_times'][start:stop], run['cluster_chans'][start:stop]
+
+# one of the averages of a run: 'evoked0', 'evoked1' or 'evoked_diff'
+def read_evoked(analysis_name, statrun=0, name='evoked_diff'):
+    run = read_meta(analysis_name)['runs'][statrun]
+    fname = op.join(results_path(analysis_name), run['evokeds'])
+    return mne.read_evokeds(fname, condition=run['evoked_names'].index(name))
+
+# the (T_obs, clusters, p_values, H0) of a run, as the mne cluster tests return them
+def read_cluster_stats(analysis_name, statrun=0):
+    run = read_run(analysis_name, statrun)
+    ptr = run['cluster_ptr']
+    times, chans = run['cluster_times'], run['cluster_chans']
+    clusters = [(times[ptr[k]:ptr[k + 1]], chans[ptr[k]:ptr[k + 1]]) for k in range(len(ptr) - 1)]
+    return run['T_obs'], clusters, run['p_values'], run['H0']
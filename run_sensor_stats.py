@@ -1,241 +1,394 @@
 import mne
+import os
 import os.path as op
 import sys
 import numpy as np
-from mne.stats import spatio_temporal_cluster_test, spatio_temporal_cluster_1samp_test, ttest_1samp_no_p
+from mne.stats import spatio_temporal_cluster_test
 from mne.datasets import sample
 from mne.channels import find_ch_connectivity
 import eeg_pipeline.config as config
-import pickle
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from mne.viz import plot_topomap
 from mne.viz import plot_compare_evokeds
 from scipy import stats as stats
+from scipy import sparse
+from mne.io.constants import FIFF
+import eeg_pipeline.artifacts as artifacts
+from eeg_pipeline.parallel import shared_memory, map_subjects, get_n_workers
+import zlib
+import time
+from eeg_pipeline.finalise import diff_name
+from eeg_pipeline.results import pack_run, save_results
+import eeg_pipeline.permutation as permutation
+from eeg_pipeline.permutation import ttest_ind_no_p, welch_ttest_no_p, tfce_test, cluster_test
 
-def run_sensor_stats():
+def run_sensor_stats(dry_run=False, n_workers=None):
+    stale = [] # analyses that need to be (re)run
     for c in np.arange(len(config.stats_params)):
        
-        # organise data and analysis parameters
-        dat0_files = config.stats_params[c]['dat0_files']
-        dat1_files = config.stats_params[c]['dat1_files']
-        condnames = config.stats_params[c]['condnames']
-        tmin, tmax = config.stats_params[c]['statwin']
-        n_permutations = config.stats_params[c]['n_permutations']
-        p_threshold = config.stats_params[c]['threshold']
-        tail = config.stats_params[c]['tail']
-        if tail == 0:
-            p_threshold = p_threshold / 2
-            tail_x = 1
+        # the data to analyse (a 'dep' analysis with diff_files needn't give dat0_files and dat1_files)
+        dat0_files = config.stats_params[c].get('dat0_files')
+        dat1_files = config.stats_params[c].get('dat1_files')
+        ismulti = is_multi(config.stats_params[c])
+        # we will run the same analysis on each subject separately if it is multi-subject
+        nruns = len(dat0_files) if ismulti else 1
+        n_jobs = perm_settings(config.stats_params[c])[0]
+
+        use_diffs = uses_diffs(config.stats_params[c])
+        diff_files = config.stats_params[c].get('diff_files')
+
+        # skip the analysis if neither its data nor its settings have changed since it was last run
+        manifest = artifacts.manifest_fname(config.stat_path, config.stats_params[c]['analysis_name'])
+        if use_diffs:
+            sources = data_fnames(diff_files, ismulti)
         else:
-            tail_x = tail
+            sources = data_fnames(dat0_files, ismulti) + data_fnames(dat1_files, ismulti)
+        params = {k: v for k, v in config.stats_params[c].items() if k not in ('n_jobs', 'buffer_size', 'perm_mem')}
+        key = artifacts.fingerprint(sources=sources, params=params,
+                                    code=[run_stats, collect_data, load_stack, channel_adjacency, data_fnames,
+                                          uses_diffs, is_multi, diff_name, permutation, perm_settings,
+                                          pack_run, save_results])
+        if not artifacts.is_stale(manifest, key):
+            print('%s is up to date' % config.stats_params[c]['analysis_name'])
+            continue
+        stale.append(config.stats_params[c]['analysis_name'])
+        if dry_run:
+            print('Would run: %s' % config.stats_params[c]['analysis_name'])
+            continue
 
-        if 'multi-subject' in config.stats_params[c] and config.stats_params[c]['multi-subject'] == True:
-            # we will run the same analysis on each subject separately
-            nruns = len(dat0_files)
-            ismulti = True      
+        t0 = time.perf_counter()
+        if ismulti and nruns > 1:
+            # the subjects are independent, so run them at once (leaving cores for each one's permutations)
+            run_workers = max(1, get_n_workers(n_workers) // n_jobs)
+            status = map_subjects(stats_batch, dat0_files, n_workers=run_workers,
+                                  log_name=config.stats_params[c]['analysis_name'], args=(c,))
+            failed = [s for s in status if not s['ok']]
+            for s in failed:
+                print('{} failed, see {}'.format(s['subj'], s['log']))
+                print(s['error'])
+            if failed:
+                # don't save a partial analysis
+                continue
+            results = [s['result'] for s in status]
         else:
-            nruns = 1     
-            ismulti = False     
+            results = [run_stats(c, statrun) for statrun in np.arange(nruns)]
 
-        results = [] # to store the results later
+        # save
+        save_name = save_results(config.stats_params[c]['analysis_name'], results, params)
+        artifacts.record(manifest, key, [save_name])
+        print('%s took %.1f s' % (config.stats_params[c]['analysis_name'], time.perf_counter() - t0))
 
-        for statrun in np.arange(nruns):                      
-            
-            if ismulti:
-                # we will run the same analysis on each subject separately
-                dat0, evokeds0, connectivity = collect_data([dat0_files[statrun]],condnames[0],tmin,tmax,ismulti)
-                dat1, evokeds1, _ = collect_data([dat1_files[statrun]],condnames[1],tmin,tmax,ismulti)    
-            else:
-                # collect together the data to be compared
-                dat0, evokeds0, connectivity = collect_data(dat0_files,condnames[0],tmin,tmax,ismulti)
-                dat1, evokeds1, _ = collect_data(dat1_files,condnames[1],tmin,tmax,ismulti)        
-                
-            alldata = [] 
-
-            # fix threshold to be one-sided if requested
-            if type(p_threshold) != 'dict': # i.e. is NOT TFCE
-                if config.stats_params[c]['stat'] == 'indep':
-                    stat_fun = ttest_ind_no_p
-                    if len(dat0_files) == 1: # ie is single subject stats
-                        df = dat0.data.shape[0] - 1 + dat1.data.shape[0] - 1                        
-                    else:
-                        df = len(dat0_files) - 1 + len(dat1_files) - 1                                                            
-                else: # ie is dependent data, and so is one-sample t test
-                    # this will only ever be group data...
-                    # If the length of dat0_files and dat1_files are different it'll crash later anyway
-                    stat_fun = ttest_1samp_no_p
-                    df = len(dat0_files) - 1
-                threshold_stat = stats.distributions.t.ppf(1. - p_threshold, df) * tail_x
-            else: # i.e. is TFCE
-                threshold_stat = p_threshold      
-        
-            # run the stats
-            if config.stats_params[c]['stat'] == 'indep':
-                alldata = [dat0,dat1]
-                cluster_stats = spatio_temporal_cluster_test(alldata, n_permutations=n_permutations,
-                                                        threshold=threshold_stat, 
-                                                        tail=tail, stat_fun=stat_fun,
-                                                        n_jobs=1, buffer_size=None,
-                                                        connectivity=connectivity)
-            elif config.stats_params[c]['stat'] == 'dep':
-                # we have to use 1-sample t-tests here so also need to subtract conditions
-                alldata = dat0 - dat1
-                cluster_stats = spatio_temporal_cluster_1samp_test(alldata, n_permutations=n_permutations,
-                                                        threshold=threshold_stat, 
-                                                        tail=tail, stat_fun=stat_fun,
-                                                        n_jobs=1, buffer_size=None,
-                                                        connectivity=connectivity)
-
-            # extract stats of interest
-            T_obs, clusters, p_values, _ = cluster_stats
-            good_cluster_inds = np.where(p_values < config.stats_params[c]['p_accept'])[0]
-
-            # tell the user the results
-            print('There are {} significant clusters'.format(good_cluster_inds.size))
-            if good_cluster_inds.size != 0:
-                print('p-values: {}'.format(p_values[good_cluster_inds]))
+    return stale
+
+# run one of the statruns of analysis c (there is one per subject for multi-subject analyses)
+def run_stats(c, statrun):
+    # organise data and analysis parameters
+    dat0_files = config.stats_params[c].get('dat0_files')
+    dat1_files = config.stats_params[c].get('dat1_files')
+    condnames = config.stats_params[c]['condnames']
+    tmin, tmax = config.stats_params[c]['statwin']
+    n_permutations = config.stats_params[c]['n_permutations']
+    p_threshold = config.stats_params[c]['threshold']
+    tail = config.stats_params[c]['tail']
+    # a dict of TFCE settings rather than a p-value
+    use_tfce = isinstance(p_threshold, dict)
+    if tail == 0:
+        if not use_tfce:
+            p_threshold = p_threshold / 2
+        tail_x = 1
+    else:
+        tail_x = tail
+    ismulti = is_multi(config.stats_params[c])
+    diff_files = config.stats_params[c].get('diff_files')
+    use_diffs = uses_diffs(config.stats_params[c])
+    n_jobs, buffer_size, seed, perm_mem = perm_settings(config.stats_params[c])
+    # stop drawing permutations once every p-value is this surely one side of p_accept (None draws them all)
+    stop_confidence = config.stats_params[c].get('stop_confidence')
+    p_accept = config.stats_params[c]['p_accept']
+
+    alldata = []
+    if use_diffs:
+        # the differences are already made, so there's no need to load both conditions
+        alldata, diffcond_avg, connectivity = collect_data(diff_files,diff_name(*condnames),tmin,tmax,ismulti)
+        dat0_avg, dat1_avg = None, None
+    elif ismulti:
+        # we will run the same analysis on each subject separately
+        dat0, dat0_avg, connectivity = collect_data([dat0_files[statrun]],condnames[0],tmin,tmax,ismulti)
+        dat1, dat1_avg, _ = collect_data([dat1_files[statrun]],condnames[1],tmin,tmax,ismulti)    
+    else:
+        # collect together the data to be compared
+        dat0, dat0_avg, connectivity = collect_data(dat0_files,condnames[0],tmin,tmax,ismulti)
+        dat1, dat1_avg, _ = collect_data(dat1_files,condnames[1],tmin,tmax,ismulti)        
+
+    # we have to use 1-sample t-tests for dependent data so also need to subtract conditions
+    if config.stats_params[c]['stat'] == 'dep' and not use_diffs:
+        alldata = dat0 - dat1
+
+    # fix threshold to be one-sided if requested
+    if not use_tfce:
+        if config.stats_params[c]['stat'] == 'indep':
+            # Student's t, or Welch's if the variances can't be assumed equal (the threshold still
+            # uses Student's degrees of freedom)
+            if config.stats_params[c].get('equal_var', True):
+                stat_fun = ttest_ind_no_p
             else:
-                if p_values.any():
-                    print('Minimum p-value: {}'.format(np.min(p_values)))
-                else:
-                    print('No clusters found')
-
-            # some final averaging and tidying
-            if len(evokeds0) == 1:
-                dat0_avg = evokeds0[0].average()
-                dat1_avg = evokeds1[0].average()
+                stat_fun = welch_ttest_no_p
+            if len(dat0_files) == 1: # ie is single subject stats
+                df = dat0.shape[0] - 1 + dat1.shape[0] - 1                        
             else:
-                dat0_avg = mne.grand_average(evokeds0)
-                dat1_avg = mne.grand_average(evokeds1)
-            diffcond_avg = mne.combine_evoked([dat0_avg, -dat1_avg], 'equal')
-            
-            # get sensor positions via layout
-            pos = mne.find_layout(evokeds0[0].info).pos
+                df = len(dat0_files) - 1 + len(dat1_files) - 1                                                            
+        else: # ie is dependent data, and so is one-sample t test
+            # the degrees of freedom of the data actually tested (the differences, however they were made)
+            df = alldata.shape[0] - 1
+        threshold_stat = stats.distributions.t.ppf(1. - p_threshold, df) * tail_x
+    else: # i.e. is TFCE
+        threshold_stat = p_threshold      
 
-            ## EVENTUALLY I WILL PUT THE PLOTTING IN A SEPARATE FUNCTION...
-            do_plot = False
-            
-            if do_plot:
-                # loop over clusters
-                for i_clu, clu_idx in enumerate(good_cluster_inds):
-                    # unpack cluster information, get unique indices
-                    time_inds, space_inds = np.squeeze(clusters[clu_idx])
-                    ch_inds = np.unique(space_inds)
-                    time_inds = np.unique(time_inds)   
-
-                    # get topography for F stat
-                    f_map = T_obs[time_inds, ...].mean(axis=0)
-
-                    # get topography of difference
-                    time_shift = evokeds0[0].time_as_index(tmin)      # fix windowing shift
-                    print('time_shift = {}'.format(time_shift))
-                    sig_times_idx = time_inds + time_shift
-                    diff_topo = np.mean(diffcond_avg.data[:,sig_times_idx],axis=1)
-                    sig_times = evokeds0[0].times[sig_times_idx]
-                    
-                    # create spatial mask
-                    mask = np.zeros((f_map.shape[0], 1), dtype=bool)
-                    mask[ch_inds, :] = True
-
-                    # initialize figure
-                    fig, ax_topo = plt.subplots(1, 1, figsize=(10, 3))
-
-                    # plot average difference and mark significant sensors
-                    image, _ = plot_topomap(diff_topo, pos, mask=mask, axes=ax_topo, cmap='RdBu_r',
-                                            vmin=np.min, vmax=np.max, show=False)
-
-                    # create additional axes (for ERF and colorbar)
-                    divider = make_axes_locatable(ax_topo)
-
-                    # add axes for colorbar
-                    ax_colorbar = divider.append_axes('right', size='5%', pad=0.05)
-                    plt.colorbar(image, cax=ax_colorbar)
-                    ax_topo.set_xlabel(
-                        'Mean difference ({:0.3f} - {:0.3f} s)'.format(*sig_times[[0, -1]]))
-
-                    # add new axis for time courses and plot time courses
-                    ax_signals = divider.append_axes('right', size='300%', pad=1.2)
-                    title = 'Cluster #{0}, {1} sensor'.format(i_clu + 1, len(ch_inds))
-                    if len(ch_inds) > 1:
-                        title += "s (mean)"
-                    plot_compare_evokeds([dat0_avg, dat1_avg], title=title, picks=ch_inds, axes=ax_signals,
-                                            colors=None, show=False,
-                                            split_legend=False, truncate_yaxis='max_ticks')
-
-                    # plot temporal cluster extent
-                    ymin, ymax = ax_signals.get_ylim()
-                    ax_signals.fill_betweenx((ymin, ymax), sig_times[0], sig_times[-1],
-                                                color='orange', alpha=0.3)
-
-                    # clean up viz
-                    mne.viz.tight_layout(fig=fig)
-                    fig.subplots_adjust(bottom=.05)
-                    plt.show()   
-
-            results.append({                    
-                'cluster_stats': cluster_stats,
-                'good_cluster_inds': good_cluster_inds,
-                'alldata': alldata,
-                'evokeds0': evokeds0,
-                'evokeds1': evokeds1
-            })
+    # each run gets its own stream of random permutations
+    rng = np.random.RandomState([seed, statrun])
 
-        # save
-        save_name = op.join(config.stat_path, config.stats_params[c]['analysis_name'] + '.dat')        
-        pickle_out = open(save_name,'wb')
-        pickle.dump(results, pickle_out)
-        pickle_out.close()
+    t0 = time.perf_counter()
+    if use_tfce:
+        # our own TFCE, which finds the clusters at every step of the threshold in one go
+        if config.stats_params[c]['stat'] == 'indep':
+            alldata = [dat0,dat1]
+        else:
+            alldata = [alldata]
+        cluster_stats = tfce_test(alldata, connectivity, threshold_stat, n_permutations=n_permutations,
+                                  tail=tail, seed=rng, equal_var=config.stats_params[c].get('equal_var', True),
+                                  max_mem=perm_mem, alpha=p_accept, confidence=stop_confidence)
+    elif config.stats_params[c]['stat'] == 'dep' or stop_confidence is not None:
+        # the sign flips (or label swaps) of a block of permutations at a time are one matrix product,
+        # and the clusters of the whole block are found at once
+        if config.stats_params[c]['stat'] == 'indep':
+            alldata = [dat0,dat1]
+        else:
+            alldata = [alldata]
+        cluster_stats = cluster_test(alldata, connectivity, threshold_stat, n_permutations=n_permutations,
+                                     tail=tail, seed=rng, equal_var=config.stats_params[c].get('equal_var', True),
+                                     max_mem=perm_mem, alpha=p_accept, confidence=stop_confidence)
+    else:
+        # run the stats (the data are shared with the workers through memory, not copied to each)
+        with shared_memory():
+            alldata = [dat0,dat1]
+            cluster_stats = spatio_temporal_cluster_test(alldata, n_permutations=n_permutations,
+                                                    threshold=threshold_stat, 
+                                                    tail=tail, stat_fun=stat_fun,
+                                                    n_jobs=n_jobs, buffer_size=buffer_size,
+                                                    seed=rng, connectivity=connectivity)
+    seconds = time.perf_counter() - t0
+    print('Run {} took {:.1f} s ({} permutations)'.format(statrun, seconds, len(cluster_stats[3])))
 
-def collect_data(dat0_files,condname,tmin,tmax,ismulti):
+    # extract stats of interest
+    T_obs, clusters, p_values, _ = cluster_stats
+    good_cluster_inds = np.where(p_values < p_accept)[0]
+
+    # tell the user the results
+    print('There are {} significant clusters'.format(good_cluster_inds.size))
+    if good_cluster_inds.size != 0:
+        print('p-values: {}'.format(p_values[good_cluster_inds]))
+    else:
+        if p_values.any():
+            print('Minimum p-value: {}'.format(np.min(p_values)))
+        else:
+            print('No clusters found')
+
+    # some final averaging and tidying
+    if not use_diffs:
+        diffcond_avg = mne.combine_evoked([dat0_avg, -dat1_avg], 'equal')
     
-    nfiles0 = len(dat0_files)
-    evokeds0 = []
-    # find the path to the data files
-    if len(dat0_files) == 1 or ismulti:
+    # get sensor positions via layout
+    pos = mne.find_layout(diffcond_avg.info).pos
+
+    ## EVENTUALLY I WILL PUT THE PLOTTING IN A SEPARATE FUNCTION...
+    do_plot = False
+    
+    if do_plot:
+        # loop over clusters
+        for i_clu, clu_idx in enumerate(good_cluster_inds):
+            # unpack cluster information, get unique indices
+            time_inds, space_inds = np.squeeze(clusters[clu_idx])
+            ch_inds = np.unique(space_inds)
+            time_inds = np.unique(time_inds)   
+
+            # get topography for F stat
+            f_map = T_obs[time_inds, ...].mean(axis=0)
+
+            # get topography of difference
+            time_shift = diffcond_avg.time_as_index(tmin)      # fix windowing shift
+            print('time_shift = {}'.format(time_shift))
+            sig_times_idx = time_inds + time_shift
+            diff_topo = np.mean(diffcond_avg.data[:,sig_times_idx],axis=1)
+            sig_times = diffcond_avg.times[sig_times_idx]
+            
+            # create spatial mask
+            mask = np.zeros((f_map.shape[0], 1), dtype=bool)
+            mask[ch_inds, :] = True
+
+            # initialize figure
+            fig, ax_topo = plt.subplots(1, 1, figsize=(10, 3))
+
+            # plot average difference and mark significant sensors
+            image, _ = plot_topomap(diff_topo, pos, mask=mask, axes=ax_topo, cmap='RdBu_r',
+                                    vmin=np.min, vmax=np.max, show=False)
+
+            # create additional axes (for ERF and colorbar)
+            divider = make_axes_locatable(ax_topo)
+
+            # add axes for colorbar
+            ax_colorbar = divider.append_axes('right', size='5%', pad=0.05)
+            plt.colorbar(image, cax=ax_colorbar)
+            ax_topo.set_xlabel(
+                'Mean difference ({:0.3f} - {:0.3f} s)'.format(*sig_times[[0, -1]]))
+
+            # add new axis for time courses and plot time courses
+            ax_signals = divider.append_axes('right', size='300%', pad=1.2)
+            title = 'Cluster #{0}, {1} sensor'.format(i_clu + 1, len(ch_inds))
+            if len(ch_inds) > 1:
+                title += "s (mean)"
+            plot_compare_evokeds([diffcond_avg] if use_diffs else [dat0_avg, dat1_avg], title=title, picks=ch_inds, axes=ax_signals,
+                                    colors=None, show=False,
+                                    split_legend=False, truncate_yaxis='max_ticks')
+
+            # plot temporal cluster extent
+            ymin, ymax = ax_signals.get_ylim()
+            ax_signals.fill_betweenx((ymin, ymax), sig_times[0], sig_times[-1],
+                                        color='orange', alpha=0.3)
+
+            # clean up viz
+            mne.viz.tight_layout(fig=fig)
+            fig.subplots_adjust(bottom=.05)
+            plt.show()   
+
+    # what was run on, so the data can be found again without keeping a copy of it
+    if use_diffs:
+        sources = data_fnames(diff_files, ismulti)
+    elif ismulti:
+        sources = data_fnames([dat0_files[statrun], dat1_files[statrun]], ismulti)
+    else:
+        sources = data_fnames(dat0_files, ismulti) + data_fnames(dat1_files, ismulti)
+
+    return {
+        'arrays': pack_run(cluster_stats, good_cluster_inds),
+        'evokeds': {'evoked0': dat0_avg, 'evoked1': dat1_avg, 'evoked_diff': diffcond_avg},
+        'sources': sources,
+        'seconds': seconds,
+    }
+
+# run the statrun of a multi-subject analysis c for the subject with this dat0 file (in a worker)
+def stats_batch(dat0_file, c):
+    return run_stats(c, config.stats_params[c]['dat0_files'].index(dat0_file))
+
+def is_multi(params):
+    return 'multi-subject' in params and params['multi-subject'] == True
+
+# for dependent group stats, use the differences made by finalise if we have them
+def uses_diffs(params):
+    return params['stat'] == 'dep' and bool(params.get('diff_files')) and not is_multi(params)
+
+# how to run the permutations: these only change how fast it goes, as the permutations
+# are all drawn up front from the seed (by default one fixed for each analysis name)
+def perm_settings(params):
+    n_jobs = params.get('n_jobs', config.n_jobs)
+    buffer_size = params.get('buffer_size')
+    perm_mem = params.get('perm_mem', config.perm_mem)
+    seed = params.get('seed')
+    if seed is None:
+        seed = zlib.crc32(params['analysis_name'].encode())
+    return n_jobs, buffer_size, seed, perm_mem
+
+# the full paths of the data files used in an analysis
+def data_fnames(dat_files, ismulti):
+    if len(dat_files) == 1 or ismulti:
         filepath = config.epoch_path
     else:        
         filepath = config.evoked_path
+    return [op.join(filepath, dat + '.fif') for dat in dat_files]
 
-    for dat_idx, dat in enumerate(dat0_files):
-            dat_file = op.join(filepath, dat + '.fif')
-            print("Loading subject: %s" % dat_file)
-            # load the files first
-            if nfiles0 != 1:
-                ev_dat0 = mne.read_evokeds(dat_file,condition=condname)
-            else:
-                ev_dat0 = mne.read_epochs(dat_file)            
-            # We use the first dataset to create empty variables we fill in subsequently
-            if dat_idx == 0:
-                if nfiles0 != 1:            
-                    dat0_orig = np.zeros((nfiles0,len(ev_dat0.times),ev_dat0.info['nchan']))
-                else:
-                    # we store all trials for single subject stats
-                    dat0_orig = ev_dat0[condname].get_data()            
-                # find electrode neighbourhoods
-                if len(ev_dat0.ch_names) == 1:
-                    connectivity = None
-                else:
-                    connectivity = find_ch_connectivity(ev_dat0.info, ch_type='eeg')     
-                    connectivity = connectivity[0]                           
-            # store the data for later plotting
-            evokeds0.append(ev_dat0.copy())
-
-            if nfiles0 != 1:
-                dat0_orig[dat_idx] = np.transpose(ev_dat0.data)
-                # select time-window of interest
-                ev_dat0_crop = ev_dat0.crop(tmin=tmin, tmax=tmax)
-                if dat_idx == 0:
-                    # create empty matrix to store the data that will actually be analysed
-                    dat0 = np.zeros((dat0_orig.shape[0],ev_dat0_crop.data.shape[1],dat0_orig.shape[2]))
-                dat0[dat_idx] = np.transpose(ev_dat0_crop.data)
-            else:
-                # select time-window of interest
-                ev_dat0_crop = ev_dat0[condname].crop(tmin=tmin, tmax=tmax)
-                dat0 = np.transpose(ev_dat0_crop.get_data(), (0, 2, 1))
+# the data of a condition (subjects or trials * times * channels) within tmin and tmax, their average
+# evoked and the channel neighbourhoods
+def collect_data(dat0_files,condname,tmin,tmax,ismulti):
+    # find the path to the data files
+    dat_fnames = data_fnames(dat0_files, ismulti)
+    nfiles0 = len(dat_fnames)
 
-    return dat0, evokeds0, connectivity
+    # everything apart from the data comes from the first file
+    if nfiles0 != 1:
+        ev_dat0 = mne.read_evokeds(dat_fnames[0],condition=condname)
+    else:
+        ev_dat0 = mne.read_epochs(dat_fnames[0], preload=False)[condname]
+    picks = mne.pick_types(ev_dat0.info, eeg=True, exclude=[])
+    info = mne.pick_info(ev_dat0.info, picks)
+    # find electrode neighbourhoods
+    if len(info['ch_names']) == 1:
+        connectivity = None
+    else:
+        connectivity = channel_adjacency(info)
 
-def ttest_ind_no_p(*args):
-    tvals, _ = stats.ttest_ind(*args)
-    return tvals
\ No newline at end of file
+    # all the data in one array, shared with every other analysis of the same files
+    stack = load_stack(dat_fnames, condname, picks)
+    # select time-window of interest (a view of the stack, so nothing is copied)
+    times = ev_dat0.times
+    sfreq = info['sfreq']
+    in_win = np.where((times >= round(tmin * sfreq) / sfreq - .5 / sfreq) &
+                      (times <= round(tmax * sfreq) / sfreq + .5 / sfreq))[0]
+    dat0 = stack[:, in_win[0]:in_win[-1] + 1]
+
+    # the average for plotting, as mne.grand_average (or Epochs.average for single subjects) would make it
+    if nfiles0 != 1:
+        comment = "Grand average (n = %d)" % len(stack)
+    else:
+        comment = condname
+    avg0 = mne.EvokedArray(stack.mean(axis=0).T, info, tmin=times[0], comment=comment, nave=len(stack))
+    avg0.times = times.copy()
+
+    return dat0, avg0, connectivity
+
+# the neighbourhoods of the EEG channels in info, only worked out once for each montage: they are
+# kept for the rest of the session and saved to disk, keyed by the channel names and positions
+_adjacency = {}
+def channel_adjacency(info):
+    chs = [[ch['ch_name'], [round(float(x), 6) for x in ch['loc'][:3]]]
+           for ch in info['chs'] if ch['kind'] == FIFF.FIFFV_EEG_CH]
+    key = artifacts.fingerprint(params={'chs': chs, 'mne': mne.__version__})
+    if key not in _adjacency:
+        adj_fname = op.join(config.stat_path, '.cache', 'adjacency_' + key + '.npz')
+        if op.isfile(adj_fname):
+            _adjacency[key] = sparse.load_npz(adj_fname)
+        else:
+            _adjacency[key] = sparse.csr_matrix(find_ch_connectivity(info, ch_type='eeg')[0])
+            os.makedirs(op.dirname(adj_fname), exist_ok=True)
+            tmp_fname = '%s.%d.tmp.npz' % (adj_fname[:-4], os.getpid())
+            sparse.save_npz(tmp_fname, _adjacency[key])
+            os.replace(tmp_fname, adj_fname)
+    return _adjacency[key]
+
+# stack the data of a condition in the files into one (subjects or trials) * times * channels array.
+# This is cached on disk, keyed by the contents of the files, and memory-mapped from there, so
+# every analysis using the same files shares one copy that is only made once.
+def load_stack(dat_fnames, condname, picks):
+    key = artifacts.fingerprint(sources=dat_fnames, params={'condname': condname, 'picks': list(picks)})
+    stack_fname = op.join(config.stat_path, '.cache', key + '.npy')
+    if not op.isfile(stack_fname):
+        os.makedirs(op.dirname(stack_fname), exist_ok=True)
+        tmp_fname = '%s.%d.tmp.npy' % (stack_fname[:-4], os.getpid())
+        if len(dat_fnames) == 1:
+            # we store all trials for single subject stats
+            print("Loading subject: %s" % dat_fnames[0])
+            data = mne.read_epochs(dat_fnames[0], preload=False)[condname].get_data()[:, picks]
+            np.save(tmp_fname, np.transpose(data, (0, 2, 1)))
+        else:
+            stack = None
+            for dat_idx, dat_file in enumerate(dat_fnames):
+                print("Loading subject: %s" % dat_file)
+                data = mne.read_evokeds(dat_file,condition=condname).data[picks].T
+                if stack is None:
+                    stack = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=data.dtype,
+                                                      shape=(len(dat_fnames),) + data.shape)
+                stack[dat_idx] = data
+            stack.flush()
+            del stack
+        # only now is it complete, so no one else can read half of it
+        os.replace(tmp_fname, stack_fname)
+    return np.load(stack_fname, mmap_mode='r')